@@ -0,0 +1,89 @@
+"""Async facade over the synchronous data-access functions in `db.py`.
+
+Every call is dispatched to a bounded thread pool so SQLAlchemy round trips
+never run on the event loop. The pool is sized to the engine's connection pool
+(`DB_MAX_WORKERS`, default 15) so queued calls wait for a thread instead of
+piling up on pool checkout.
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional, List, Tuple
+
+from . import db
+from .schemas import Room
+
+
+DB_MAX_WORKERS = int(os.environ.get('DB_MAX_WORKERS', '15'))
+
+_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix='db')
+
+
+async def run(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def init_db() -> None:
+    await run(db.init_db)
+
+
+async def create_room(language: str = 'javascript') -> Room:
+    return await run(db.create_room, language)
+
+
+async def create_rooms(specs: List[Tuple[str, List[str]]]) -> List[Tuple[Room, List[dict]]]:
+    return await run(db.create_rooms, specs)
+
+
+async def get_room(room_id: str) -> Optional[Room]:
+    return await run(db.get_room, room_id)
+
+
+async def add_participant(room_id: str, name: str) -> Optional[dict]:
+    return await run(db.add_participant, room_id, name)
+
+
+async def update_participants(room_id: str, add: List[str], remove: List[str]) -> Optional[Tuple[Room, List[dict], List[str]]]:
+    return await run(db.update_participants, room_id, add, remove)
+
+
+async def list_participants(room_id: str) -> Optional[List[dict]]:
+    return await run(db.list_participants, room_id)
+
+
+async def remove_participant(room_id: str, participant_id: str) -> bool:
+    return await run(db.remove_participant, room_id, participant_id)
+
+
+async def update_code(room_id: str, code: str) -> Optional[Room]:
+    return await run(db.update_code, room_id, code)
+
+
+async def update_language(room_id: str, language: str) -> Optional[Room]:
+    return await run(db.update_language, room_id, language)
+
+
+async def apply_code_ops(room_id: str, base_revision: int, ops: List[dict]) -> Optional[Tuple[Room, List[dict]]]:
+    return await run(db.apply_code_ops, room_id, base_revision, ops)
+
+
+async def get_revision(room_id: str, revision: int) -> Optional[dict]:
+    return await run(db.get_revision, room_id, revision)
+
+
+async def list_revisions(room_id: str, start: int = 0, end: Optional[int] = None) -> Optional[dict]:
+    return await run(db.list_revisions, room_id, start, end)
+
+
+async def expire_rooms(cutoff: int, keep: Iterable[str] = (), limit: int = 200) -> List[str]:
+    return await run(db.expire_rooms, cutoff, keep, limit)
+
+
+async def purge_orphans(limit: int = 200) -> int:
+    return await run(db.purge_orphans, limit)
+
+
+async def flush_code(all_rooms: bool = False) -> int:
+    return await run(db.flush_code, all_rooms)
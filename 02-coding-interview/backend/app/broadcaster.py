@@ -1,46 +1,284 @@
-from typing import Dict, Set
+from typing import Awaitable, Callable, Dict, Optional, Set
 from fastapi import WebSocket
 import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from . import metrics
+from .protocol import TEXT_JSON, Codec, Frame
+from .pubsub import InMemoryBackend
+
+
+logger = logging.getLogger(__name__)
+
+# queued in place of the dropped backlog of a connection that fell behind
+_RESYNC = object()
+
+
+class _Connection:
+    # Outgoing side of one WebSocket: a bounded queue drained by its own task so
+    # a slow client only ever delays itself.
+    def __init__(self, broadcaster: "Broadcaster", websocket: WebSocket):
+        self.broadcaster = broadcaster
+        self.websocket = websocket
+        self.rooms: Set[str] = set()
+        self.codec: Codec = TEXT_JSON
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=broadcaster.queue_size)
+        # set while the connection is in snapshot mode: deltas are skipped until it is resynced
+        self.resync: Optional[Set[str]] = None
+        self.closed = False
+        self.task = self.loop.create_task(self._drain())
+
+    def enqueue(self, data: Frame) -> None:
+        # broadcasts may come from another event loop (e.g. the test client)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._enqueue(data)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._enqueue, data)
+
+    def _enqueue(self, data: Frame) -> None:
+        if self.closed or self.resync is not None:
+            return
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            # slow consumer: drop its backlog and fall back to a fresh snapshot per room
+            self.broadcaster.downgrades += 1
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.resync = set(self.rooms)
+            self.queue.put_nowait(_RESYNC)
+
+    async def _drain(self):
+        b = self.broadcaster
+        try:
+            while True:
+                data = await self.queue.get()
+                if data is _RESYNC:
+                    rooms, self.resync = self.resync or set(), None
+                    if b.snapshot_loader is None:
+                        raise RuntimeError("connection fell behind and no snapshot loader is configured")
+                    for room_id in rooms:
+                        message = await b.snapshot_loader(room_id)
+                        if message is not None:
+                            await self._send(self.codec.encode(b.encode(message), message))
+                    continue
+                await self._send(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.info("dropping websocket that could not keep up", exc_info=True)
+            b.failed_sends += 1
+            b._drop(self)
+            try:
+                await self.websocket.close(code=1013)
+            except Exception:
+                pass
+
+    async def _send(self, frame: Frame):
+        if isinstance(frame, str):
+            send = self.websocket.send_text(frame)
+            encoding = 'json-text'
+        else:
+            send = self.websocket.send_bytes(frame)
+            encoding = self.codec.encoding
+        with metrics.WS_SEND_DURATION.time():
+            await asyncio.wait_for(send, self.broadcaster.send_timeout)
+        metrics.WS_BYTES_SENT.inc(len(frame), encoding=encoding)
+
+
+class _Coalesced:
+    def __init__(self, last_sent: float):
+        self.last_sent = last_sent
+        self.message: Optional[dict] = None
+        self.timer: Optional[asyncio.Task] = None
+
+    def timer_pending(self) -> bool:
+        # a timer whose event loop has gone away will never fire
+        return self.timer is not None and not self.timer.done() and not self.timer.get_loop().is_closed()
 
 
 class Broadcaster:
-    def __init__(self):
+    def __init__(self, queue_size: int = 64, send_timeout: float = 5.0, backend=None, coalesce_window: float = 0.0):
         # Map room_id -> set of WebSocket connections
         self.subscribers: Dict[str, Set[WebSocket]] = {}
-        self.lock = asyncio.Lock()
+        self.connections: Dict[WebSocket, _Connection] = {}
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        # async callable room_id -> full ROOM_UPDATE message, used to resync slow consumers
+        self.snapshot_loader: Optional[Callable[[str], Awaitable[Optional[dict]]]] = None
+        # plain lock: callers may live on different event loops and nothing awaits while holding it
+        self.lock = threading.Lock()
+        self.failed_sends = 0
+        self.downgrades = 0
+        self.coalesce_window = coalesce_window
+        self._coalesced: Dict[str, _Coalesced] = {}
+        self.coalesced_messages = 0
+        # carries broadcasts to every worker (this one included)
+        self.backend = backend or InMemoryBackend()
+        self.backend.bind(self._deliver_local)
+
+    async def start(self):
+        await self.backend.start(self._deliver_local)
+
+    async def stop(self):
+        await self.backend.stop()
+
+    @staticmethod
+    def encode(message: dict) -> str:
+        return json.dumps(message, separators=(',', ':'))
+
+    def _connection(self, websocket: WebSocket) -> _Connection:
+        # caller holds the lock
+        conn = self.connections.get(websocket)
+        if conn is None:
+            conn = self.connections[websocket] = _Connection(self, websocket)
+        return conn
+
+    def set_codec(self, websocket: WebSocket, codec: Codec) -> None:
+        # frames already queued keep the encoding they were queued with
+        with self.lock:
+            self._connection(websocket).codec = codec
 
     async def subscribe(self, websocket: WebSocket, room_id: str):
-        async with self.lock:
+        with self.lock:
+            conn = self._connection(websocket)
             conns = self.subscribers.setdefault(room_id.upper(), set())
             conns.add(websocket)
+            conn.rooms.add(room_id.upper())
 
     async def unsubscribe(self, websocket: WebSocket, room_id: str | None = None):
-        async with self.lock:
+        with self.lock:
             if room_id:
                 conns = self.subscribers.get(room_id.upper(), set())
                 conns.discard(websocket)
+                conn = self.connections.get(websocket)
+                if conn:
+                    conn.rooms.discard(room_id.upper())
             else:
                 for conns in self.subscribers.values():
                     conns.discard(websocket)
+                conn = self.connections.pop(websocket, None)
+                if conn:
+                    conn.closed = True
+                    conn.task.cancel()
+
+    def _drop(self, conn: _Connection) -> None:
+        with self.lock:
+            conn.closed = True
+            self.connections.pop(conn.websocket, None)
+            for room_id in conn.rooms:
+                self.subscribers.get(room_id, set()).discard(conn.websocket)
+
+    def active_rooms(self) -> Set[str]:
+        # rooms with at least one subscriber on this worker
+        with self.lock:
+            return {room_id for room_id, conns in self.subscribers.items() if conns}
+
+    def prune(self) -> int:
+        """Forget rooms nobody on this worker is subscribed to; returns the entries removed."""
+        with self.lock:
+            empty = [room_id for room_id, conns in self.subscribers.items() if not conns]
+            for room_id in empty:
+                del self.subscribers[room_id]
+            self._prune_coalesced(time.monotonic())
+        return len(empty)
+
+    async def send(self, websocket: WebSocket, message: dict):
+        # queue a message for one connection, ordered with its broadcasts
+        with self.lock:
+            conn = self._connection(websocket)
+        conn.enqueue(conn.codec.encode(self.encode(message), message))
+
+    def _deliver_local(self, room_id: str, data: str) -> None:
+        # hand an encoded message to each local subscriber's queue without awaiting the sends
+        with self.lock:
+            conns = [self.connections[ws] for ws in self.subscribers.get(room_id, ()) if ws in self.connections]
+        # frame once per wire format in use, not once per connection
+        frames: Dict[tuple, Frame] = {}
+        parsed = None
+        for conn in conns:
+            codec = conn.codec
+            frame = frames.get(codec.key)
+            if frame is None:
+                if codec.encoding == 'msgpack' and parsed is None:
+                    parsed = json.loads(data)
+                frame = frames[codec.key] = codec.encode(data, parsed)
+            conn.enqueue(frame)
 
     async def broadcast(self, room_id: str, message: dict):
+        # encode once; the backend delivers it to subscribers on every worker
+        with metrics.BROADCAST_FANOUT.time():
+            await self.backend.publish(room_id.upper(), self.encode(message))
+
+    async def schedule(self, room_id: str, message: dict):
+        """Broadcast a room snapshot, merging bursts into one message per coalescing window.
+
+        The first snapshot in a quiet room goes out immediately; later ones within
+        the window replace each other and only the latest is sent when it closes.
+        """
+        if self.coalesce_window <= 0:
+            await self.broadcast(room_id, message)
+            return
         room_key = room_id.upper()
-        async with self.lock:
-            conns = set(self.subscribers.get(room_key, set()))
+        now = time.monotonic()
+        with self.lock:
+            state = self._coalesced.get(room_key)
+            if state is not None and state.timer_pending():
+                if state.message is not None:
+                    self.coalesced_messages += 1
+                state.message = message
+                return
+            elapsed = now - state.last_sent if state is not None else self.coalesce_window
+            if elapsed >= self.coalesce_window:
+                self._coalesced[room_key] = _Coalesced(now)
+                if len(self._coalesced) > 1024:
+                    self._prune_coalesced(now)
+            else:
+                state.message = message
+                state.timer = asyncio.get_running_loop().create_task(
+                    self._flush_coalesced(room_key, self.coalesce_window - elapsed)
+                )
+                return
+        await self.broadcast(room_key, message)
+
+    async def _flush_coalesced(self, room_key: str, delay: float):
+        await asyncio.sleep(delay)
+        with self.lock:
+            state = self._coalesced.get(room_key)
+            if state is None or state.message is None:
+                return
+            message, state.message = state.message, None
+            state.last_sent = time.monotonic()
+        await self.broadcast(room_key, message)
+
+    def _prune_coalesced(self, now: float) -> None:
+        # forget rooms that have been quiet for longer than the window; caller holds the lock
+        for key in [k for k, st in self._coalesced.items() if now - st.last_sent >= self.coalesce_window and not st.timer_pending()]:
+            del self._coalesced[key]
 
-        # send without holding lock
-        dead: Set[WebSocket] = set()
-        for ws in conns:
-            try:
-                await ws.send_json(message)
-            except Exception:
-                dead.add(ws)
 
-        if dead:
-            async with self.lock:
-                conns = self.subscribers.get(room_key, set())
-                for d in dead:
-                    conns.discard(d)
+def backend_from_env():
+    kind = os.environ.get('BROADCAST_BACKEND', 'memory')
+    if kind == 'postgres':
+        from .pubsub import PostgresBackend
+        return PostgresBackend(os.environ.get('BROADCAST_DATABASE_URL') or os.environ['DATABASE_URL'])
+    if kind != 'memory':
+        raise ValueError(f"unknown BROADCAST_BACKEND {kind!r}")
+    return InMemoryBackend()
 
 
-broadcaster = Broadcaster()
+broadcaster = Broadcaster(
+    queue_size=int(os.environ.get('WS_SEND_QUEUE_SIZE', '64')),
+    send_timeout=int(os.environ.get('WS_SEND_TIMEOUT_MS', '5000')) / 1000,
+    backend=backend_from_env(),
+    coalesce_window=int(os.environ.get('BROADCAST_COALESCE_MS', '40')) / 1000,
+)
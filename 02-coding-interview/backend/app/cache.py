@@ -0,0 +1,88 @@
+"""Bounded in-process room cache with LRU eviction and a TTL.
+
+Entries written by mutators are authoritative. Values loaded after a miss are
+stored with `fill`, which drops them if any invalidation happened since the
+load began, so a slow read can never overwrite a newer value.
+"""
+from collections import OrderedDict
+import threading
+import time
+from typing import Generic, Optional, Tuple, TypeVar
+
+
+V = TypeVar('V')
+
+
+class RoomCache(Generic[V]):
+    def __init__(self, max_size: int = 1024, ttl: float = 5.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, key: str) -> Tuple[Optional[V], int]:
+        """Return (value or None, generation to pass to `fill` after a miss)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value, self._generation
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+            return None, self._generation
+
+    def put(self, key: str, value: V) -> None:
+        with self._lock:
+            self._generation += 1
+            self._store(key, value)
+
+    def fill(self, key: str, value: V, generation: int) -> None:
+        with self._lock:
+            if generation == self._generation:
+                self._store(key, value)
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._generation += 1
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def _store(self, key: str, value: V) -> None:
+        if not self.enabled:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxSize": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
@@ -1,12 +1,17 @@
 import os
 import time
-import random
-from typing import Optional, List
+import secrets
+import threading
+from typing import Iterable, Optional, List, Tuple, Dict
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, func, update, insert, bindparam, tuple_
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, Session
 
-from . import models
+from . import history, metrics, migrations, models
+from .ops import OpLog, apply_ops, transform
+from .write_behind import CodeBuffer, PendingCode
+from .cache import RoomCache
 from .schemas import Room, Participant
 
 
@@ -16,93 +21,222 @@ if not DATABASE_URL:
     DATABASE_URL = 'sqlite:///./backend_dev.db'
 
 engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if DATABASE_URL.startswith('sqlite') else {})
-SessionLocal = sessionmaker(bind=engine)
+metrics.instrument_engine(engine)
+# keep loaded attributes after commit so building the response does not re-query the row
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
 
 # ensure mappers registered
 models.start_mappers()
 
+# recent ops per room so concurrent edits can be rebased onto the latest revision
+op_log = OpLog(int(os.environ.get('OPS_HISTORY_SIZE', '200')))
+
+# striped locks serialise code edits to the same room within this process
+_room_locks = [threading.Lock() for _ in range(64)]
+
+
+class RevisionConflict(Exception):
+    # raised when edit ops cannot be rebased onto the room's current revision
+    def __init__(self, room: Room):
+        super().__init__(f"revision conflict in room {room.id}")
+        self.room = room
+
+
+def _room_lock(rid: str) -> threading.Lock:
+    return _room_locks[hash(rid) % len(_room_locks)]
+
+
+def _insert_revisions(conn, rows: List[dict]) -> None:
+    # history rows a previous attempt (or another process) already wrote are skipped
+    revisions = models.RoomRevisionModel.__table__
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif conn.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        conn.execute(insert(revisions), rows)
+        return
+    conn.execute(dialect_insert(revisions).on_conflict_do_nothing(), rows)
+
+
+def _flush_code(batch: Dict[str, PendingCode]) -> None:
+    # one transaction per flush; never overwrite a newer revision written elsewhere
+    rooms = models.RoomModel.__table__
+    stmt = (
+        update(rooms)
+        .where(rooms.c.id == bindparam('b_id'), rooms.c.revision < bindparam('b_revision'))
+        .values(code=bindparam('b_code'), revision=bindparam('b_revision'), updated_at=bindparam('b_updated_at'))
+    )
+    updated_at = int(time.time() * 1000)
+    params = [{"b_id": rid, "b_code": p.code, "b_revision": p.revision, "b_updated_at": updated_at} for rid, p in batch.items()]
+    revision_rows = [dict(row, room_id=rid) for rid, p in batch.items() for row in p.history]
+    with engine.begin() as conn:
+        conn.execute(stmt, params)
+        if revision_rows:
+            _insert_revisions(conn, revision_rows)
+
+
+# code updates are coalesced in memory and written in batches when enabled
+WRITE_BEHIND = os.environ.get('CODE_WRITE_BEHIND', '1') not in ('0', 'false', 'no')
+CODE_FLUSH_INTERVAL = int(os.environ.get('CODE_FLUSH_INTERVAL_MS', '250')) / 1000
+code_buffer = CodeBuffer(
+    _flush_code,
+    idle=int(os.environ.get('CODE_FLUSH_IDLE_MS', '500')) / 1000,
+    max_delay=int(os.environ.get('CODE_MAX_DIRTY_MS', '2000')) / 1000,
+)
+
+
+# recently read rooms; entries are replaced or invalidated by every mutator in this process
+room_cache: RoomCache[Room] = RoomCache(
+    max_size=int(os.environ.get('ROOM_CACHE_SIZE', '1024')),
+    ttl=int(os.environ.get('ROOM_CACHE_TTL_MS', '5000')) / 1000,
+)
+
+
+def flush_code(all_rooms: bool = False) -> int:
+    # write buffered code that is due (or everything, e.g. on shutdown)
+    return code_buffer.flush() if all_rooms else code_buffer.flush_due()
+
+
+_ID_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+
 
 def _generate_id() -> str:
-    return ''.join(random.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(6))
+    return ''.join(secrets.choice(_ID_ALPHABET) for _ in range(6))
+
+
+def _allocate_room_ids(db: Session, n: int) -> List[str]:
+    # draw candidates in bulk and drop any already taken, in one query per round
+    rooms = models.RoomModel.__table__
+    ids: set = set()
+    while len(ids) < n:
+        candidates = {_generate_id() for _ in range(n - len(ids))} - ids
+        taken = set(db.execute(select(rooms.c.id).where(rooms.c.id.in_(candidates))).scalars())
+        ids |= candidates - taken
+    return list(ids)
+
+
+def _participant_ids(n: int) -> List[str]:
+    # unique within the batch; a clash with an existing row fails the insert
+    ids: set = set()
+    while len(ids) < n:
+        ids.add(_generate_id())
+    return list(ids)
+
+
+def _default_code(language: str) -> str:
+    if language == 'python':
+        return '# Write your Python code here\nprint("Hello, World!")\n'
+    return '// Write your JavaScript code here\nconsole.log("Hello, World!");\n'
 
 
 def init_db() -> None:
-    # create tables
-    models.metadata.create_all(bind=engine)
+    # create or upgrade the schema
+    migrations.run(engine)
 
 
-def _room_from_model(row) -> Room:
-    # row is an instance of models.RoomModel
-    # count participants
-    db: Session = SessionLocal()
-    try:
-        parts = db.query(models.ParticipantModel).filter(models.ParticipantModel.room_id == row.id).count()
-    finally:
-        db.close()
-    return Room(id=row.id, code=row.code, language=row.language, createdAt=row.created_at, participants=parts)
+def _room_query(db: Session, rid: str):
+    # load the room and its participant count in a single round trip
+    parts = (
+        select(func.count(models.ParticipantModel.id))
+        .where(models.ParticipantModel.room_id == models.RoomModel.id)
+        .correlate(models.RoomModel)
+        .scalar_subquery()
+    )
+    return db.query(models.RoomModel, parts).filter(models.RoomModel.id == rid)
+
+
+def _room_from_model(row, participants: int) -> Room:
+    # row is an instance of models.RoomModel; buffered code takes precedence over the stored row
+    code, revision = row.code, row.revision
+    pending = code_buffer.get(row.id)
+    if pending and pending.revision > revision:
+        code, revision = pending.code, pending.revision
+    return Room(id=row.id, code=code, language=row.language, createdAt=row.created_at, participants=participants, revision=revision)
 
 
 def create_room(language: str = 'javascript') -> Room:
-    rid = _generate_id()
-    default_code = '# Write your Python code here\nprint("Hello, World!")\n' if language == 'python' else '// Write your JavaScript code here\nconsole.log("Hello, World!");\n'
+    default_code = _default_code(language)
     created_at = int(time.time() * 1000)
     db: Session = SessionLocal()
     try:
+        rid = _allocate_room_ids(db, 1)[0]
         room = models.RoomModel()
         room.id = rid
         room.code = default_code
         room.language = language
         room.created_at = created_at
+        room.updated_at = created_at
+        room.revision = 0
         db.add(room)
-        # create one anonymous participant
-        pid = _generate_id()
-        p = models.ParticipantModel()
-        p.id = pid
-        p.room_id = rid
-        p.name = None
-        p.joined_at = int(time.time() * 1000)
-        db.add(p)
+        # the room's history starts with a keyframe of the default code
+        db.execute(insert(models.RoomRevisionModel.__table__), dict(history.revision_row(0, default_code, None), room_id=rid))
         db.commit()
     finally:
         db.close()
 
-    return Room(id=rid, code=default_code, language=language, createdAt=created_at, participants=1)
+    room = Room(id=rid, code=default_code, language=language, createdAt=created_at, participants=0)
+    room_cache.put(rid, room)
+    return room
 
 
-def get_room(room_id: str) -> Optional[Room]:
-    rid = room_id.upper()
-    db: Session = SessionLocal()
-    try:
-        row = db.query(models.RoomModel).filter(models.RoomModel.id == rid).first()
-        if not row:
-            return None
-        return _room_from_model(row)
-    finally:
-        db.close()
+def create_rooms(specs: List[Tuple[str, List[str]]], attempts: int = 3) -> List[Tuple[Room, List[dict]]]:
+    """Create a room per (language, participant names) spec in a single transaction.
+
+    IDs are checked against existing rooms up front; a collision with a
+    concurrent creator surfaces as an IntegrityError and the batch is retried.
+    """
+    rooms = models.RoomModel.__table__
+    participants = models.ParticipantModel.__table__
+    for attempt in range(attempts):
+        created_at = int(time.time() * 1000)
+        db: Session = SessionLocal()
+        try:
+            room_ids = _allocate_room_ids(db, len(specs))
+            part_ids = iter(_participant_ids(sum(len(names) for _, names in specs)))
 
+            room_rows, revision_rows, part_rows, out = [], [], [], []
+            for rid, (language, names) in zip(room_ids, specs):
+                code = _default_code(language)
+                room_rows.append({"id": rid, "code": code, "language": language, "created_at": created_at, "updated_at": created_at, "revision": 0})
+                revision_rows.append(dict(history.revision_row(0, code, None), room_id=rid))
+                parts = [{"id": next(part_ids), "room_id": rid, "name": name, "joined_at": created_at} for name in names]
+                part_rows.extend(parts)
+                room = Room(id=rid, code=code, language=language, createdAt=created_at, participants=len(parts))
+                out.append((room, [{"id": p["id"], "name": p["name"], "joinedAt": p["joined_at"]} for p in parts]))
+            db.execute(insert(rooms), room_rows)
+            db.execute(insert(models.RoomRevisionModel.__table__), revision_rows)
+            if part_rows:
+                db.execute(insert(participants), part_rows)
+            db.commit()
+            return out
+        except IntegrityError:
+            db.rollback()
+            if attempt == attempts - 1:
+                raise
+        finally:
+            db.close()
 
-def join_room(room_id: str) -> Optional[Room]:
+
+def get_room(room_id: str) -> Optional[Room]:
     rid = room_id.upper()
+    cached, generation = room_cache.get(rid)
+    if cached is not None:
+        return cached
     db: Session = SessionLocal()
     try:
-        row = db.query(models.RoomModel).filter(models.RoomModel.id == rid).first()
-        if not row:
+        found = _room_query(db, rid).first()
+        if not found:
             return None
-        # add an anonymous participant
-        pid = _generate_id()
-        p = models.ParticipantModel()
-        p.id = pid
-        p.room_id = rid
-        p.name = None
-        p.joined_at = int(time.time() * 1000)
-        db.add(p)
-        db.commit()
-        return _room_from_model(row)
+        row, parts = found
+        room = _room_from_model(row, parts)
+        room_cache.fill(rid, room, generation)
+        return room
     finally:
         db.close()
 
 
-def add_participant(room_id: str, name: Optional[str] = None) -> Optional[dict]:
+def add_participant(room_id: str, name: str) -> Optional[dict]:
     rid = room_id.upper()
     db: Session = SessionLocal()
     try:
@@ -117,11 +251,45 @@ def add_participant(room_id: str, name: Optional[str] = None) -> Optional[dict]:
         p.joined_at = int(time.time() * 1000)
         db.add(p)
         db.commit()
+        room_cache.invalidate(rid)
         return {"id": pid, "name": name, "joinedAt": p.joined_at}
     finally:
         db.close()
 
 
+def update_participants(room_id: str, add: List[str], remove: List[str]) -> Optional[Tuple[Room, List[dict], List[str]]]:
+    """Add participants by name and remove participants by id in one commit.
+
+    Returns the updated room, the participants added and the ids actually removed.
+    """
+    rid = room_id.upper()
+    participants = models.ParticipantModel.__table__
+    with _room_lock(rid):
+        db: Session = SessionLocal()
+        try:
+            found = _room_query(db, rid).first()
+            if not found:
+                return None
+            row, parts = found
+            joined_at = int(time.time() * 1000)
+            added = [{"id": pid, "name": name, "joinedAt": joined_at} for pid, name in zip(_participant_ids(len(add)), add)]
+            if added:
+                db.execute(insert(participants), [{"id": p["id"], "room_id": rid, "name": p["name"], "joined_at": joined_at} for p in added])
+            removed: List[str] = []
+            if remove:
+                removed = list(db.execute(
+                    participants.delete()
+                    .where(participants.c.room_id == rid, participants.c.id.in_(set(remove)))
+                    .returning(participants.c.id)
+                ).scalars())
+            db.commit()
+            room = _room_from_model(row, parts + len(added) - len(removed))
+            room_cache.put(rid, room)
+            return room, added, removed
+        finally:
+            db.close()
+
+
 def list_participants(room_id: str) -> Optional[List[dict]]:
     rid = room_id.upper()
     db: Session = SessionLocal()
@@ -129,7 +297,12 @@ def list_participants(room_id: str) -> Optional[List[dict]]:
         row = db.query(models.RoomModel).filter(models.RoomModel.id == rid).first()
         if not row:
             return None
-        parts = db.query(models.ParticipantModel).filter(models.ParticipantModel.room_id == rid).all()
+        parts = (
+            db.query(models.ParticipantModel)
+            .filter(models.ParticipantModel.room_id == rid)
+            .order_by(models.ParticipantModel.joined_at)
+            .all()
+        )
         return [{"id": p.id, "name": p.name, "joinedAt": p.joined_at} for p in parts]
     finally:
         db.close()
@@ -144,49 +317,216 @@ def remove_participant(room_id: str, participant_id: str) -> bool:
             return False
         db.delete(p)
         db.commit()
+        room_cache.invalidate(rid)
         return True
     finally:
         db.close()
 
 
-def leave_room(room_id: str) -> bool:
-    # leave room removes one anonymous participant if present
+def _store_code(rid: str, code: str, revision: int, record: dict, expected: Optional[int] = None) -> bool:
+    # persist code and its history row now, or stage both for the write-behind flush
+    if WRITE_BEHIND:
+        code_buffer.put(rid, code, revision, record)
+        return True
+    rooms = models.RoomModel.__table__
+    stmt = update(rooms).where(rooms.c.id == rid).values(code=code, revision=revision, updated_at=int(time.time() * 1000))
+    if expected is not None:
+        # compare-and-swap on the revision guards against writers in other processes
+        stmt = stmt.where(rooms.c.revision == expected)
+    with engine.begin() as conn:
+        if conn.execute(stmt).rowcount != 1:
+            return False
+        _insert_revisions(conn, [dict(record, room_id=rid)])
+        return True
+
+
+def update_code(room_id: str, code: str) -> Optional[Room]:
     rid = room_id.upper()
-    db: Session = SessionLocal()
-    try:
-        p = db.query(models.ParticipantModel).filter(models.ParticipantModel.room_id == rid).first()
-        if p:
-            db.delete(p)
+    with _room_lock(rid):
+        room = get_room(rid)
+        if not room:
+            return None
+        previous = room.code
+        room = room.model_copy(update={"code": code, "revision": room.revision + 1})
+        record = history.revision_row(room.revision, code, history.diff_ops(previous, code))
+        if not _store_code(rid, code, room.revision, record):
+            room_cache.invalidate(rid)
+            return None
+        room_cache.put(rid, room)
+        # a whole-document replace cannot be rebased over
+        op_log.append(rid, room.revision, None)
+        return room
+
+
+def apply_code_ops(room_id: str, base_revision: int, ops: List[dict]) -> Optional[Tuple[Room, List[dict]]]:
+    """Apply edit ops made against `base_revision` and return the room and the ops as applied.
+
+    Raises RevisionConflict when the ops cannot be rebased onto the current
+    revision and ValueError when they fall outside the document.
+    """
+    rid = room_id.upper()
+    with _room_lock(rid):
+        room = get_room(rid)
+        if not room:
+            return None
+        current = room.revision
+        missed = op_log.since(rid, base_revision, current) if base_revision <= current else None
+        if missed is None:
+            raise RevisionConflict(room)
+        ops = transform(ops, missed)
+        room = room.model_copy(update={"code": apply_ops(room.code, ops), "revision": current + 1})
+        record = history.revision_row(room.revision, room.code, ops)
+        if not _store_code(rid, room.code, room.revision, record, expected=current):
+            # another process moved the room on; drop our view of it and let the client resync
+            room_cache.invalidate(rid)
+            current_room = get_room(rid)
+            if not current_room:
+                return None
+            raise RevisionConflict(current_room)
+        room_cache.put(rid, room)
+        op_log.append(rid, room.revision, ops)
+        return room, ops
+
+
+def update_language(room_id: str, language: str) -> Optional[Room]:
+    rid = room_id.upper()
+    with _room_lock(rid):
+        db: Session = SessionLocal()
+        try:
+            found = _room_query(db, rid).first()
+            if not found:
+                return None
+            row, parts = found
+            row.language = language
+            row.updated_at = int(time.time() * 1000)
             db.commit()
-            return True
-        return False
-    finally:
-        db.close()
+            room = _room_from_model(row, parts)
+            room_cache.put(rid, room)
+            return room
+        finally:
+            db.close()
 
 
-def update_code(room_id: str, code: str) -> Optional[Room]:
+# most changes returned by one list_revisions call
+REVISION_PAGE_SIZE = int(os.environ.get('REVISION_PAGE_SIZE', '500'))
+
+
+def _revision_rows(db: Session, rid: str, start: int, end: int):
+    # history from the last keyframe at or before `start` (or the first one, if history begins later) up to `end`
+    revisions = models.RoomRevisionModel.__table__
+    keyframes = select(func.max(revisions.c.revision)).where(revisions.c.room_id == rid, revisions.c.keyframe)
+    first = func.coalesce(
+        keyframes.where(revisions.c.revision <= start).scalar_subquery(),
+        select(func.min(revisions.c.revision)).where(revisions.c.room_id == rid, revisions.c.keyframe).scalar_subquery(),
+    )
+    return db.execute(
+        select(revisions.c.revision, revisions.c.keyframe, revisions.c.data, revisions.c.created_at)
+        .where(revisions.c.room_id == rid, revisions.c.revision >= first, revisions.c.revision <= end)
+        .order_by(revisions.c.revision)
+    ).all()
+
+
+def get_revision(room_id: str, revision: int) -> Optional[dict]:
+    """Rebuild the code of one revision from its nearest keyframe and the deltas after it."""
     rid = room_id.upper()
+    # buffered revisions are written first so history reads see them
+    code_buffer.flush([rid])
     db: Session = SessionLocal()
     try:
-        row = db.query(models.RoomModel).filter(models.RoomModel.id == rid).first()
-        if not row:
-            return None
-        row.code = code
-        db.commit()
-        return _room_from_model(row)
+        rows = _revision_rows(db, rid, revision, revision)
     finally:
         db.close()
+    if not rows or rows[-1].revision != revision:
+        return None
+    for rev, code, created_at in history.replay(rows):
+        pass
+    return {"revision": rev, "code": code, "createdAt": created_at}
 
 
-def update_language(room_id: str, language: str) -> Optional[Room]:
+def list_revisions(room_id: str, start: int = 0, end: Optional[int] = None) -> Optional[dict]:
+    """Code at revision `start` plus the edit ops of each later revision up to `end`.
+
+    `start` is moved forward to the first recorded revision when history
+    begins after it, and at most REVISION_PAGE_SIZE changes are returned.
+    """
     rid = room_id.upper()
+    code_buffer.flush([rid])
+    end = start + REVISION_PAGE_SIZE if end is None else min(end, start + REVISION_PAGE_SIZE)
     db: Session = SessionLocal()
     try:
-        row = db.query(models.RoomModel).filter(models.RoomModel.id == rid).first()
-        if not row:
-            return None
-        row.language = language
-        db.commit()
-        return _room_from_model(row)
+        rows = _revision_rows(db, rid, start, end)
     finally:
         db.close()
+    if not rows:
+        return None
+    snapshot: Optional[dict] = None
+    changes: List[dict] = []
+    previous = None
+    for (rev, keyframe, data, _), (_, code, created_at) in zip(rows, history.replay(rows)):
+        if rev <= start or snapshot is None:
+            snapshot = {"roomId": rid, "revision": rev, "code": code, "createdAt": created_at}
+        else:
+            ops = history.diff_ops(previous, code) if keyframe else history.unpack_ops(data)
+            changes.append({"revision": rev, "ops": ops, "createdAt": created_at})
+        previous = code
+    return dict(snapshot, changes=changes)
+
+
+def _idle_rooms(cutoff: int):
+    # no code or language change and nobody joining since `cutoff`
+    rooms = models.RoomModel.__table__
+    participants = models.ParticipantModel.__table__
+    joined = select(participants.c.id).where(participants.c.room_id == rooms.c.id, participants.c.joined_at >= cutoff).exists()
+    return (rooms.c.updated_at < cutoff) & ~joined
+
+
+def expire_rooms(cutoff: int, keep: Iterable[str] = (), limit: int = 200) -> List[str]:
+    """Delete up to `limit` rooms idle since `cutoff` (ms) together with their participants and history.
+
+    Rooms in `keep` (e.g. with live subscribers) and rooms with buffered code are
+    left alone. Returns the ids deleted.
+    """
+    rooms = models.RoomModel.__table__
+    participants = models.ParticipantModel.__table__
+    revisions = models.RoomRevisionModel.__table__
+    keep = list(keep)
+    query = select(rooms.c.id).where(_idle_rooms(cutoff)).order_by(rooms.c.updated_at).limit(limit)
+    if keep:
+        query = query.where(rooms.c.id.not_in(keep))
+    with engine.begin() as conn:
+        candidates = [rid for rid in conn.execute(query).scalars() if code_buffer.get(rid) is None]
+        if not candidates:
+            return []
+        # re-checked on delete in case a room came back to life in the meantime
+        expired = list(conn.execute(
+            rooms.delete().where(rooms.c.id.in_(candidates), _idle_rooms(cutoff)).returning(rooms.c.id)
+        ).scalars())
+        if expired:
+            # SQLite does not cascade unless foreign keys are switched on
+            conn.execute(participants.delete().where(participants.c.room_id.in_(expired)))
+            conn.execute(revisions.delete().where(revisions.c.room_id.in_(expired)))
+    for rid in expired:
+        room_cache.invalidate(rid)
+        code_buffer.discard(rid)
+        op_log.discard(rid)
+    return expired
+
+
+def purge_orphans(limit: int = 200) -> int:
+    # delete up to `limit` participant and history rows whose room no longer exists
+    rooms = models.RoomModel.__table__
+    participants = models.ParticipantModel.__table__
+    revisions = models.RoomRevisionModel.__table__
+    # aliased so the subqueries are not correlated with the table being deleted from
+    parts = participants.alias()
+    revs = revisions.alias()
+    orphan_parts = select(parts.c.id).where(~select(rooms.c.id).where(rooms.c.id == parts.c.room_id).exists()).limit(limit)
+    orphan_revisions = select(revs.c.room_id, revs.c.revision).where(
+        ~select(rooms.c.id).where(rooms.c.id == revs.c.room_id).exists()
+    ).limit(limit)
+    with engine.begin() as conn:
+        deleted = conn.execute(participants.delete().where(participants.c.id.in_(orphan_parts))).rowcount
+        deleted += conn.execute(
+            revisions.delete().where(tuple_(revisions.c.room_id, revisions.c.revision).in_(orphan_revisions))
+        ).rowcount
+    return deleted
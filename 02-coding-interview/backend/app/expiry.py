@@ -0,0 +1,93 @@
+"""Background expiry of idle rooms.
+
+Every `ROOM_GC_INTERVAL_S` seconds the collector deletes rooms with no code or
+language change and nobody joining for `ROOM_IDLE_TTL_S` seconds, then
+participant and history rows whose room is gone. Deletes run in batches of
+`ROOM_GC_BATCH_SIZE`, each in its own short transaction, with a pause in between
+so the collector never holds locks for long. Rooms with subscribers on this
+worker or anyone present are kept; empty subscriber entries are pruned from
+the broadcaster.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from . import async_db
+from .broadcaster import Broadcaster, broadcaster
+from .presence import PresenceRegistry, presence
+
+
+logger = logging.getLogger(__name__)
+
+
+class RoomExpiry:
+    def __init__(self, broadcaster: Broadcaster, ttl: float, interval: float = 300.0, batch_size: int = 200, pause: float = 0.05, presence: Optional[PresenceRegistry] = None):
+        self.broadcaster = broadcaster
+        self.presence = presence
+        self.ttl = ttl
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.runs = 0
+        self.rooms_expired = 0
+        self.orphans_purged = 0
+        self.subscribers_pruned = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.interval > 0
+
+    async def collect(self) -> int:
+        """Run one expiry pass; returns the number of rooms deleted."""
+        cutoff = int((time.time() - self.ttl) * 1000)
+        expired = 0
+        while True:
+            keep = self.broadcaster.active_rooms()
+            if self.presence is not None:
+                keep |= self.presence.rooms()
+            ids = await async_db.expire_rooms(cutoff, keep, self.batch_size)
+            expired += len(ids)
+            if len(ids) < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        while True:
+            purged = await async_db.purge_orphans(self.batch_size)
+            self.orphans_purged += purged
+            # each call deletes up to one batch of participants and one of history rows
+            if purged < self.batch_size:
+                break
+            await asyncio.sleep(self.pause)
+        self.subscribers_pruned += self.broadcaster.prune()
+        self.rooms_expired += expired
+        self.runs += 1
+        return expired
+
+    async def run_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                expired = await self.collect()
+                if expired:
+                    logger.info("expired %d idle rooms", expired)
+            except Exception:
+                logger.exception("room expiry pass failed")
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "roomsExpired": self.rooms_expired,
+            "orphansPurged": self.orphans_purged,
+            "subscribersPruned": self.subscribers_pruned,
+        }
+
+
+# ROOM_IDLE_TTL_S=0 disables expiry
+room_expiry = RoomExpiry(
+    broadcaster,
+    ttl=int(os.environ.get('ROOM_IDLE_TTL_S', str(7 * 24 * 3600))),
+    interval=int(os.environ.get('ROOM_GC_INTERVAL_S', '300')),
+    batch_size=int(os.environ.get('ROOM_GC_BATCH_SIZE', '200')),
+    presence=presence,
+)
@@ -0,0 +1,94 @@
+"""Compact revision history for room code.
+
+Every code change is stored as a row in `room_revisions`. Most rows are deltas:
+the edit ops that turn the previous revision into this one, packed as
+``[pos, text]`` (insert) or ``[pos, length]`` (delete) pairs. Every
+`KEYFRAME_INTERVAL` revisions, and when a room is created, the row holds the
+full document instead, so rebuilding any revision reads one keyframe and at
+most `KEYFRAME_INTERVAL - 1` deltas.
+"""
+import difflib
+import json
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+
+from .ops import apply_ops
+
+
+KEYFRAME_INTERVAL = max(1, int(os.environ.get('REVISION_KEYFRAME_INTERVAL', '50')))
+
+
+def diff_ops(old: str, new: str) -> List[dict]:
+    """Edit ops turning `old` into `new`, diffed line by line between the common prefix and suffix."""
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[-1 - suffix] == new[-1 - suffix]:
+        suffix += 1
+    a = old[prefix:len(old) - suffix]
+    b = new[prefix:len(new) - suffix]
+    if not a and not b:
+        return []
+    if not a or not b or ('\n' not in a and '\n' not in b):
+        return _replace_ops(prefix, len(a), b)
+
+    a_lines = a.splitlines(keepends=True)
+    b_lines = b.splitlines(keepends=True)
+    ops: List[dict] = []
+    # ops apply left to right, so everything before the current hunk is already `new`
+    pos = prefix
+    b_done = 0
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, a_lines, b_lines, autojunk=False).get_opcodes():
+        pos += sum(len(line) for line in b_lines[b_done:j1])
+        b_done = j1
+        if tag == 'equal':
+            continue
+        ops += _replace_ops(pos, sum(len(line) for line in a_lines[i1:i2]), ''.join(b_lines[j1:j2]))
+    return ops
+
+
+def _replace_ops(pos: int, length: int, text: str) -> List[dict]:
+    ops = []
+    if length:
+        ops.append({'type': 'delete', 'pos': pos, 'length': length})
+    if text:
+        ops.append({'type': 'insert', 'pos': pos, 'text': text})
+    return ops
+
+
+def pack_ops(ops: List[dict]) -> str:
+    return json.dumps([[op['pos'], op['text'] if op['type'] == 'insert' else op['length']] for op in ops], separators=(',', ':'))
+
+
+def unpack_ops(data: str) -> List[dict]:
+    return [
+        {'type': 'insert', 'pos': pos, 'text': arg} if isinstance(arg, str) else {'type': 'delete', 'pos': pos, 'length': arg}
+        for pos, arg in json.loads(data)
+    ]
+
+
+def revision_row(revision: int, code: str, ops: Optional[List[dict]]) -> dict:
+    # history row (without room_id) for a new revision; `ops` is None when there is no previous revision
+    keyframe = ops is None or revision % KEYFRAME_INTERVAL == 0
+    return {
+        "revision": revision,
+        "keyframe": keyframe,
+        "data": code if keyframe else pack_ops(ops),
+        "created_at": int(time.time() * 1000),
+    }
+
+
+def replay(rows: Iterable[Tuple[int, bool, str, int]]) -> Iterable[Tuple[int, str, int]]:
+    """Yield (revision, code, created_at) for rows ordered by revision, starting at a keyframe."""
+    code: Optional[str] = None
+    for revision, keyframe, data, created_at in rows:
+        if keyframe:
+            code = data
+        elif code is None:
+            raise ValueError(f"revision {revision} has no preceding keyframe")
+        else:
+            code = apply_ops(code, unpack_ops(data))
+        yield revision, code, created_at
@@ -1,17 +1,33 @@
-from fastapi import FastAPI, HTTPException, status, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse, FileResponse
+import asyncio
+import logging
+
+from fastapi import FastAPI, HTTPException, Query, status, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from . import db
+from . import async_db, db, metrics, protocol
+from .db import RevisionConflict
 from .schemas import (
     CreateRoomRequest,
+    CreateRoomsBatchRequest,
+    CreateRoomsBatchResponse,
+    BulkParticipantsRequest,
+    BulkParticipantsResponse,
     Room,
     UpdateCodeRequest,
+    ApplyOpsRequest,
+    ApplyOpsResponse,
+    RoomRevision,
+    RevisionHistory,
     UpdateLanguageRequest,
     ErrorResponse,
     Participant,
 )
 from .broadcaster import broadcaster
+from .expiry import room_expiry
+from .presence import presence
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Coding Interview Backend")
 
@@ -22,6 +38,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware, routes=app.routes)
 
 # Serve SPA static files if present in app/static
 try:
@@ -31,50 +48,137 @@ except Exception:
     pass
 
 
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _flush_code_loop():
+    # periodically write buffered code for rooms that are idle or past the durability bound
+    while True:
+        await asyncio.sleep(db.CODE_FLUSH_INTERVAL)
+        try:
+            await async_db.flush_code()
+        except Exception:
+            logger.exception("flushing buffered code failed")
+
+
+async def _presence_loop():
+    # drop expired join leases and silent heartbeat clients, and tell the rooms
+    while True:
+        await asyncio.sleep(max(presence.ttl / 4, 1))
+        try:
+            await _broadcast_presence(presence.sweep())
+        except Exception:
+            logger.exception("presence sweep failed")
+
+
 @app.on_event("startup")
 async def startup_event():
     # ensure database tables exist when the app starts (tests rely on this)
     try:
-        db.init_db()
+        await async_db.init_db()
     except Exception:
         # avoid crashing startup in case of DB issues; tests will show errors
         pass
+    if db.WRITE_BEHIND:
+        _background_tasks.add(asyncio.create_task(_flush_code_loop()))
+    _background_tasks.add(asyncio.create_task(_presence_loop()))
+    if room_expiry.enabled:
+        _background_tasks.add(asyncio.create_task(room_expiry.run_forever()))
+    await broadcaster.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+    await broadcaster.stop()
+    # persist everything still buffered before the process exits
+    try:
+        await async_db.flush_code(all_rooms=True)
+    except Exception:
+        logger.exception("flushing buffered code on shutdown failed")
+
+
+def _present(room: Room) -> Room:
+    # stored named participants plus whoever is connected right now
+    return room.model_copy(update={"participants": room.participants + presence.count(room.id)})
+
+
+def _room_message(room: Room) -> dict:
+    return {"type": "ROOM_UPDATE", "roomId": room.id, "room": _present(room).model_dump()}
+
+
+async def _broadcast_room(room: Room):
+    # room snapshots are coalesced per room; the latest state is always delivered
+    await broadcaster.schedule(room.id, _room_message(room))
+
+
+async def _broadcast_presence(room_ids):
+    for room_id in room_ids:
+        room = await async_db.get_room(room_id)
+        if room:
+            await _broadcast_room(room)
 
 
 @app.post("/rooms", response_model=Room, status_code=201)
 async def create_room(payload: CreateRoomRequest | None = None):
     language = payload.language if payload is not None and payload.language else "javascript"
-    room = db.create_room(language)
+    room = await async_db.create_room(language)
     return room
 
 
+@app.post("/rooms/batch", response_model=CreateRoomsBatchResponse, status_code=201)
+async def create_rooms_batch(payload: CreateRoomsBatchRequest):
+    # provision many rooms (and their named participants) in one transaction
+    specs = [(spec.language or "javascript", spec.participants) for spec in payload.rooms]
+    created = await async_db.create_rooms(specs)
+    return {"rooms": [{"room": room, "participants": parts} for room, parts in created]}
+
+
 @app.post("/rooms/{room_id}/join", response_model=Room)
 async def join_room(room_id: str):
-    room = db.join_room(room_id)
+    room = await async_db.get_room(room_id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
+    # in-memory lease, taken over by the client's WebSocket subscription
+    presence.lease(room.id)
     # broadcast update
-    await broadcaster.broadcast(room.id, {"type": "ROOM_UPDATE", "roomId": room.id, "room": room.model_dump()})
-    return room
+    await _broadcast_room(room)
+    return _present(room)
 
 
 @app.post("/rooms/{room_id}/participants", status_code=201)
 async def create_participant(room_id: str, payload: dict | None = None):
-    # payload may contain {"name": "Alice"}
+    # payload must contain {"name": "Alice"}; anonymous presence is not stored
     name = payload.get("name") if payload else None
-    part = db.add_participant(room_id, name)
+    if not isinstance(name, str) or not name:
+        raise HTTPException(status_code=400, detail="Participant name is required")
+    part = await async_db.add_participant(room_id, name)
     if not part:
         raise HTTPException(status_code=404, detail="Room not found")
     # broadcast updated room state as well
-    room = db.get_room(room_id)
+    room = await async_db.get_room(room_id)
     if room:
-        await broadcaster.broadcast(room.id, {"type": "ROOM_UPDATE", "roomId": room.id, "room": room.model_dump()})
+        await _broadcast_room(room)
     return part
 
 
+@app.post("/rooms/{room_id}/participants/bulk", response_model=BulkParticipantsResponse)
+async def bulk_participants(room_id: str, payload: BulkParticipantsRequest):
+    result = await async_db.update_participants(room_id, payload.add, payload.remove)
+    if not result:
+        raise HTTPException(status_code=404, detail="Room not found")
+    room, added, removed = result
+    # one snapshot for the whole batch
+    if added or removed:
+        await _broadcast_room(room)
+    return {"room": _present(room), "added": added, "removed": removed}
+
+
 @app.get("/rooms/{room_id}/participants")
 async def get_participants(room_id: str):
-    parts = db.list_participants(room_id)
+    parts = await async_db.list_participants(room_id)
     if parts is None:
         raise HTTPException(status_code=404, detail="Room not found")
     return parts
@@ -82,85 +186,218 @@ async def get_participants(room_id: str):
 
 @app.delete("/rooms/{room_id}/participants/{participant_id}", status_code=204)
 async def delete_participant(room_id: str, participant_id: str):
-    ok = db.remove_participant(room_id, participant_id)
+    ok = await async_db.remove_participant(room_id, participant_id)
     if not ok:
         raise HTTPException(status_code=404, detail="Participant or room not found")
-    room = db.get_room(room_id)
+    room = await async_db.get_room(room_id)
     if room:
-        await broadcaster.broadcast(room.id, {"type": "ROOM_UPDATE", "roomId": room.id, "room": room.model_dump()})
+        await _broadcast_room(room)
     return JSONResponse(status_code=204, content=None)
 
 
 @app.get("/rooms/{room_id}", response_model=Room)
 async def get_room(room_id: str):
-    room = db.get_room(room_id)
+    room = await async_db.get_room(room_id)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    return room
+    return _present(room)
 
 
 @app.patch("/rooms/{room_id}/code", response_model=Room)
 async def patch_code(room_id: str, payload: UpdateCodeRequest):
-    room = db.update_code(room_id, payload.code)
+    room = await async_db.update_code(room_id, payload.code)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    await broadcaster.broadcast(room.id, {"type": "ROOM_UPDATE", "roomId": room.id, "room": room.model_dump()})
-    return room
+    await _broadcast_room(room)
+    return _present(room)
+
+
+@app.post("/rooms/{room_id}/code/ops", response_model=ApplyOpsResponse)
+async def post_code_ops(room_id: str, payload: ApplyOpsRequest):
+    # incremental edit: only the (rebased) ops are stored in the op log and rebroadcast
+    ops = [op.model_dump() for op in payload.ops]
+    try:
+        result = await async_db.apply_code_ops(room_id, payload.baseRevision, ops)
+    except RevisionConflict as e:
+        raise HTTPException(status_code=409, detail={"message": "Revision conflict", "room": _present(e.room).model_dump()})
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not result:
+        raise HTTPException(status_code=404, detail="Room not found")
+    room, applied = result
+    await broadcaster.broadcast(room.id, {
+        "type": "CODE_OPS",
+        "roomId": room.id,
+        "baseRevision": room.revision - 1,
+        "revision": room.revision,
+        "ops": applied,
+        "clientId": payload.clientId,
+    })
+    return {"roomId": room.id, "revision": room.revision, "ops": applied}
+
+
+@app.get("/rooms/{room_id}/revisions", response_model=RevisionHistory)
+async def get_revisions(room_id: str, start: int = Query(0, alias="from", ge=0), end: int | None = Query(None, alias="to", ge=0)):
+    # playback: the code at `from` followed by the ops of each later revision
+    if end is not None and end < start:
+        raise HTTPException(status_code=400, detail="'to' must not be before 'from'")
+    found = await async_db.list_revisions(room_id, start, end)
+    if not found:
+        raise HTTPException(status_code=404, detail="Room not found")
+    return found
+
+
+@app.get("/rooms/{room_id}/revisions/{revision}", response_model=RoomRevision)
+async def get_revision(room_id: str, revision: int):
+    found = await async_db.get_revision(room_id, revision)
+    if not found:
+        room = await async_db.get_room(room_id)
+        raise HTTPException(status_code=404, detail="Revision not found" if room else "Room not found")
+    return found
 
 
 @app.patch("/rooms/{room_id}/language", response_model=Room)
 async def patch_language(room_id: str, payload: UpdateLanguageRequest):
-    room = db.update_language(room_id, payload.language)
+    room = await async_db.update_language(room_id, payload.language)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    await broadcaster.broadcast(room.id, {"type": "ROOM_UPDATE", "roomId": room.id, "room": room.model_dump()})
-    return room
+    await _broadcast_room(room)
+    return _present(room)
 
 
 @app.post("/rooms/{room_id}/leave", status_code=204)
 async def post_leave(room_id: str):
-    ok = db.leave_room(room_id)
-    if not ok:
+    room = await async_db.get_room(room_id)
+    if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    room = db.get_room(room_id)
-    if room:
-        await broadcaster.broadcast(room.id, {"type": "ROOM_UPDATE", "roomId": room.id, "room": room.model_dump()})
+    # a join lease not yet taken over by a WebSocket; subscriptions leave by disconnecting
+    if presence.leave(room.id):
+        await _broadcast_room(room)
     return JSONResponse(status_code=204, content=None)
 
 
+@app.get("/stats")
+async def get_stats():
+    return {"roomCache": db.room_cache.stats(), "codeBuffer": db.code_buffer.stats(), "roomExpiry": room_expiry.stats(), "presence": presence.stats()}
+
+
+async def _room_snapshot(room_id: str):
+    room = await async_db.get_room(room_id)
+    if not room:
+        return None
+    return _room_message(room)
+
+
+# lets the broadcaster resync a client that fell behind with a fresh snapshot
+broadcaster.snapshot_loader = _room_snapshot
+
+
+def _app_metrics():
+    with broadcaster.lock:
+        per_room = {(room_id,): len(conns) for room_id, conns in broadcaster.subscribers.items() if conns}
+        connections = len(broadcaster.connections)
+    lines = metrics.sample_lines('ws_room_subscribers', 'WebSocket subscribers per room on this worker.', per_room, ('room',))
+    lines += metrics.sample_lines('ws_subscribers', 'Room subscriptions held by this worker.', {(): sum(per_room.values())})
+    lines += metrics.sample_lines('ws_connections', 'Open WebSocket connections with at least one subscription.', {(): connections})
+    lines += metrics.sample_lines('ws_failed_sends_total', 'WebSocket sends that failed or timed out.', {(): broadcaster.failed_sends}, kind='counter')
+    lines += metrics.sample_lines('ws_downgrades_total', 'Slow WebSocket consumers switched to snapshot resync.', {(): broadcaster.downgrades}, kind='counter')
+    lines += metrics.sample_lines('broadcast_coalesced_total', 'Room snapshots superseded within a coalescing window.', {(): broadcaster.coalesced_messages}, kind='counter')
+    cache = db.room_cache.stats()
+    lines += metrics.sample_lines('room_cache', 'Room cache counters and size.', {(k,): v for k, v in cache.items()}, ('stat',))
+    buffered = db.code_buffer.stats()
+    lines += metrics.sample_lines('code_buffer', 'Write-behind code buffer counters.', {(k,): v for k, v in buffered.items()}, ('stat',))
+    expiry = room_expiry.stats()
+    present = presence.stats()
+    lines += metrics.sample_lines('room_presence', 'Presence tracked by this worker: rooms, present holders, expired holders.', {(k,): v for k, v in present.items()}, ('stat',))
+    lines += metrics.sample_lines('room_expiry', 'Idle room expiry counters.', {(k,): v for k, v in expiry.items()}, ('stat',), kind='counter')
+    return lines
+
+
+metrics.register_collector(_app_metrics)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def _room_ids(data: dict) -> list[str]:
+    # a single "roomId" or a batch in "roomIds"
+    ids = list(data.get('roomIds') or [])
+    if data.get('roomId'):
+        ids.append(data['roomId'])
+    return [rid.upper() for rid in ids if isinstance(rid, str) and rid]
+
+
 @app.websocket('/ws')
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     subscriptions: set[str] = set()
+    codec = protocol.TEXT_JSON
     try:
         while True:
-            data = await websocket.receive_json()
-            # Expect messages like {"action": "subscribe", "roomId": "ABC123"}
+            frame = await websocket.receive()
+            if frame['type'] == 'websocket.disconnect':
+                break
+            try:
+                data = codec.decode(frame['text'] if frame.get('text') is not None else frame['bytes'])
+            except Exception:
+                # ignore frames we cannot decode
+                continue
+            # Expect messages like {"action": "subscribe", "roomId": "ABC123"} or {"action": "subscribe", "roomIds": [...]}
             action = data.get('action')
-            if action == 'subscribe':
-                room_id = data.get('roomId')
-                if room_id:
+            if action == 'hello':
+                # negotiate the wire format; the reply is still sent in the current one
+                new_codec = protocol.negotiate(data)
+                await broadcaster.send(websocket, {
+                    "type": "WELCOME",
+                    "version": new_codec.version,
+                    "encoding": new_codec.encoding,
+                    "compress": new_codec.compress,
+                    "compressThreshold": new_codec.threshold,
+                })
+                broadcaster.set_codec(websocket, new_codec)
+                codec = new_codec
+            elif action == 'subscribe':
+                room_ids = [rid for rid in _room_ids(data) if rid not in subscriptions]
+                for room_id in room_ids:
                     await broadcaster.subscribe(websocket, room_id)
-                    subscriptions.add(room_id.upper())
-                    # send current room state immediately to the new subscriber
-                    try:
-                        current_room = db.get_room(room_id)
-                        if current_room:
-                            await websocket.send_json({"type": "ROOM_UPDATE", "roomId": current_room.id, "room": current_room.model_dump()})
-                    except Exception:
-                        # don't let a single failure break the websocket loop
-                        pass
+                    subscriptions.add(room_id)
+                joined = {rid for rid in room_ids if presence.join(rid, websocket)}
+                rooms = await asyncio.gather(*(async_db.get_room(rid) for rid in room_ids), return_exceptions=True)
+                for room_id, room in zip(room_ids, rooms):
+                    # don't let a single failure break the websocket loop
+                    if isinstance(room, BaseException):
+                        continue
+                    if room is None:
+                        presence.leave(room_id, websocket)
+                    elif room_id in joined:
+                        # everyone, the new subscriber included, gets the new count
+                        await _broadcast_room(room)
+                    else:
+                        # send current room state immediately to the new subscriber
+                        await broadcaster.send(websocket, _room_message(room))
             elif action == 'unsubscribe':
-                room_id = data.get('roomId')
-                if room_id:
+                left = []
+                for room_id in _room_ids(data):
                     await broadcaster.unsubscribe(websocket, room_id)
-                    subscriptions.discard(room_id.upper())
+                    subscriptions.discard(room_id)
+                    if presence.leave(room_id, websocket):
+                        left.append(room_id)
+                await _broadcast_presence(left)
+            elif action == 'ping':
+                # heartbeat: from now on the client is dropped if it goes quiet
+                presence.touch(websocket)
+                await broadcaster.send(websocket, {"type": "PONG"})
             else:
                 # ignore unknown actions
                 pass
     except WebSocketDisconnect:
+        pass
+    finally:
         # cleanup
         await broadcaster.unsubscribe(websocket)
+        await _broadcast_presence(presence.leave_all(websocket))
 
 
 @app.get("/")
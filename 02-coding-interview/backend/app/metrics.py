@@ -0,0 +1,234 @@
+"""Minimal Prometheus-style metrics: counters, gauges and histograms rendered in
+the text exposition format, plus collectors that sample state at scrape time.
+"""
+import resource
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from starlette.routing import Match
+
+
+LabelValues = Tuple[str, ...]
+
+_metrics: List["_Metric"] = []
+_collectors: List[Callable[[], Iterable[str]]] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}'] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f'{self.name}{_labels(self.label_names, k)} {v}' for k, v in items]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += 1
+            row[-1] += value
+
+    def time(self, **labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        names = self.label_names + ('le',)
+        lines = []
+        for key, row in items:
+            for bound, count in zip(self.buckets, row):
+                lines.append(f'{self.name}_bucket{_labels(names, key + (bound,))} {count}')
+            lines.append(f'{self.name}_bucket{_labels(names, key + ("+Inf",))} {row[-2]}')
+            lines.append(f'{self.name}_count{_labels(self.label_names, key)} {row[-2]}')
+            lines.append(f'{self.name}_sum{_labels(self.label_names, key)} {row[-1]}')
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def sample_lines(name: str, help: str, values: Dict[Tuple, float], labels: Sequence[str] = (), kind: str = 'gauge') -> List[str]:
+    # for collectors: render a value sampled at scrape time
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+    lines += [f'{name}{_labels(labels, k)} {v}' for k, v in values.items()]
+    return lines
+
+
+def register_collector(collector: Callable[[], Iterable[str]]) -> None:
+    _collectors.append(collector)
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _metrics:
+        lines += metric.render()
+    for collector in _collectors:
+        lines += collector()
+    return '\n'.join(lines) + '\n'
+
+
+def _process_gauges() -> List[str]:
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return []
+    return sample_lines('process_resident_memory_bytes', 'Resident set size of this process.', {(): rss})
+
+
+register_collector(_process_gauges)
+
+
+REQUEST_DURATION = Histogram('http_request_duration_seconds', 'HTTP request latency by route.', ('method', 'route', 'status'))
+REQUESTS_IN_FLIGHT = Gauge('http_requests_in_flight', 'HTTP requests currently being served by route.', ('method', 'route'))
+BROADCAST_FANOUT = Histogram('broadcast_fanout_seconds', 'Time to encode a broadcast and hand it to every local subscriber queue.')
+WS_SEND_DURATION = Histogram('ws_send_duration_seconds', 'Time to write one frame to a WebSocket.')
+WS_BYTES_SENT = Counter('ws_bytes_sent_total', 'WebSocket payload bytes sent by wire encoding.', ('encoding',))
+DB_QUERY_DURATION = Histogram('db_query_duration_seconds', 'SQL statement execution time by statement type.', ('statement',))
+DB_POOL_EVENTS = Counter('db_pool_events_total', 'Connection pool events (connect, checkout, checkin).', ('event',))
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording per-route latency and in-flight HTTP requests."""
+
+    def __init__(self, app, routes=()):
+        self.app = app
+        self.routes = routes
+
+    def _route(self, scope) -> str:
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, 'path', 'unmatched')
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        method = scope['method']
+        route = self._route(scope)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        REQUESTS_IN_FLIGHT.inc(method=method, route=route)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec(method=method, route=route)
+            REQUEST_DURATION.observe(time.perf_counter() - start, method=method, route=route, status=status[0])
+
+
+def instrument_engine(engine) -> None:
+    """Record query counts/durations and pool events for a SQLAlchemy engine."""
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['query_start'].pop()
+        verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        DB_QUERY_DURATION.observe(time.perf_counter() - started, statement=verb)
+
+    for name in ('connect', 'checkout', 'checkin'):
+        event.listen(engine, name, lambda *args, _name=name: DB_POOL_EVENTS.inc(event=_name))
+
+    def _pool_gauges():
+        pool = engine.pool
+        values = {}
+        for stat in ('size', 'checkedin', 'checkedout', 'overflow'):
+            fn = getattr(pool, stat, None)
+            if callable(fn):
+                values[(stat,)] = fn()
+        return sample_lines('db_pool_connections', 'Connection pool state sampled at scrape time.', values, ('state',))
+
+    register_collector(_pool_gauges)
@@ -0,0 +1,116 @@
+"""Versioned schema migrations.
+
+Applied versions are recorded in `schema_migrations`. Every migration checks
+the live schema before changing it, so databases created by the old
+`metadata.create_all` startup (tables present, no version table) are brought
+up to date in place. On Postgres an advisory lock keeps workers that start at
+the same time from racing each other.
+
+Run manually with ``python -m app.migrations``.
+"""
+import time
+from typing import Callable, Iterable, List, Tuple
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect, literal, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from . import models
+
+
+_meta = MetaData()
+schema_migrations = Table(
+    'schema_migrations', _meta,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(128), nullable=False),
+    Column('applied_at', Integer, nullable=False),
+)
+
+# arbitrary application-wide key for pg_advisory_xact_lock
+_LOCK_KEY = 724051
+
+
+def _columns(conn: Connection, table: str) -> set:
+    return {c['name'] for c in inspect(conn).get_columns(table)}
+
+
+def _create_indexes(conn: Connection, table: Table, names: Iterable[str]) -> None:
+    # only the named indexes: later migrations may add indexes on columns that do not exist yet
+    existing = {ix['name'] for ix in inspect(conn).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in names and index.name not in existing:
+            index.create(conn)
+
+
+def _initial_tables(conn: Connection) -> None:
+    tables = [models.metadata.tables['rooms'], models.metadata.tables['participants']]
+    models.metadata.create_all(conn, tables=tables, checkfirst=True)
+
+
+def _room_revision(conn: Connection) -> None:
+    if 'revision' not in _columns(conn, 'rooms'):
+        conn.execute(text('ALTER TABLE rooms ADD COLUMN revision INTEGER NOT NULL DEFAULT 0'))
+
+
+def _room_and_participant_indexes(conn: Connection) -> None:
+    _create_indexes(conn, models.metadata.tables['participants'], ['ix_participants_room_id_joined_at'])
+    _create_indexes(conn, models.metadata.tables['rooms'], ['ix_rooms_created_at'])
+
+
+def _room_revisions(conn: Connection) -> None:
+    revisions = models.metadata.tables['room_revisions']
+    revisions.create(conn, checkfirst=True)
+    # history starts with the current code of existing rooms
+    rooms = models.metadata.tables['rooms']
+    existing = select(revisions.c.room_id).where(revisions.c.room_id == rooms.c.id).exists()
+    conn.execute(revisions.insert().from_select(
+        ['room_id', 'revision', 'keyframe', 'data', 'created_at'],
+        select(rooms.c.id, rooms.c.revision, literal(True), rooms.c.code, rooms.c.created_at).where(~existing),
+    ))
+
+
+def _room_updated_at(conn: Connection) -> None:
+    if 'updated_at' not in _columns(conn, 'rooms'):
+        conn.execute(text('ALTER TABLE rooms ADD COLUMN updated_at INTEGER NOT NULL DEFAULT 0'))
+        conn.execute(text('UPDATE rooms SET updated_at = created_at'))
+    _create_indexes(conn, models.metadata.tables['rooms'], ['ix_rooms_updated_at'])
+
+
+def _drop_anonymous_participants(conn: Connection) -> None:
+    # anonymous presence is tracked in memory now; these rows only skewed the counts
+    participants = models.metadata.tables['participants']
+    conn.execute(participants.delete().where(participants.c.name.is_(None)))
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, 'initial rooms and participants tables', _initial_tables),
+    (2, 'rooms.revision', _room_revision),
+    (3, 'participants(room_id, joined_at) and rooms(created_at) indexes', _room_and_participant_indexes),
+    (4, 'room_revisions history table', _room_revisions),
+    (5, 'rooms.updated_at for idle expiry', _room_updated_at),
+    (6, 'drop anonymous participant rows', _drop_anonymous_participants),
+]
+
+
+def run(engine: Engine) -> List[int]:
+    """Apply pending migrations in order; returns the versions applied."""
+    applied: List[int] = []
+    # the migrations read table definitions from the mapped metadata
+    models.start_mappers()
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {"key": _LOCK_KEY})
+        schema_migrations.create(conn, checkfirst=True)
+        done = set(conn.execute(schema_migrations.select().with_only_columns(schema_migrations.c.version)).scalars())
+        for version, name, migrate in MIGRATIONS:
+            if version in done:
+                continue
+            migrate(conn)
+            conn.execute(schema_migrations.insert().values(version=version, name=name, applied_at=int(time.time() * 1000)))
+            applied.append(version)
+    return applied
+
+
+if __name__ == '__main__':
+    from .db import engine
+    versions = run(engine)
+    print(f"applied migrations: {versions}" if versions else "schema is up to date")
@@ -1,5 +1,5 @@
 from __future__ import annotations
-from sqlalchemy import Table, Column, String, Integer, Text, ForeignKey, MetaData
+from sqlalchemy import Table, Column, String, Integer, Text, Boolean, ForeignKey, MetaData, Index, PrimaryKeyConstraint
 from sqlalchemy.orm import registry, relationship
 
 mapper_registry = registry()
@@ -12,6 +12,8 @@ class RoomModel:
     code = Column(Text, nullable=False)
     language = Column(String(16), nullable=False)
     created_at = Column(Integer, nullable=False)
+    revision = Column(Integer, nullable=False, default=0)
+    updated_at = Column(Integer, nullable=False, default=0)
 
 
 class ParticipantModel:
@@ -22,6 +24,15 @@ class ParticipantModel:
     joined_at = Column(Integer, nullable=False)
 
 
+class RoomRevisionModel:
+    __tablename__ = 'room_revisions'
+    room_id = Column(String(32), ForeignKey('rooms.id', ondelete='CASCADE'), nullable=False)
+    revision = Column(Integer, nullable=False)
+    keyframe = Column(Boolean, nullable=False)
+    data = Column(Text, nullable=False)
+    created_at = Column(Integer, nullable=False)
+
+
 def start_mappers():
     # Register mappings if not already done
     try:
@@ -31,6 +42,11 @@ def start_mappers():
             Column('code', Text, nullable=False),
             Column('language', String(16), nullable=False),
             Column('created_at', Integer, nullable=False),
+            Column('revision', Integer, nullable=False, default=0, server_default='0'),
+            # last code or language change, in ms; drives idle room expiry
+            Column('updated_at', Integer, nullable=False, default=0, server_default='0'),
+            Index('ix_rooms_created_at', 'created_at'),
+            Index('ix_rooms_updated_at', 'updated_at'),
         ))
         mapper_registry.map_imperatively(ParticipantModel, Table(
             ParticipantModel.__tablename__, metadata,
@@ -38,6 +54,18 @@ def start_mappers():
             Column('room_id', String(32), ForeignKey('rooms.id', ondelete='CASCADE'), nullable=False),
             Column('name', String(128), nullable=True),
             Column('joined_at', Integer, nullable=False),
+            # serves both per-room lookups/counts (leading column) and listing in join order
+            Index('ix_participants_room_id_joined_at', 'room_id', 'joined_at'),
+        ))
+        mapper_registry.map_imperatively(RoomRevisionModel, Table(
+            RoomRevisionModel.__tablename__, metadata,
+            Column('room_id', String(32), ForeignKey('rooms.id', ondelete='CASCADE'), nullable=False),
+            Column('revision', Integer, nullable=False),
+            # full document when true, packed edit ops against the previous revision otherwise
+            Column('keyframe', Boolean, nullable=False),
+            Column('data', Text, nullable=False),
+            Column('created_at', Integer, nullable=False),
+            PrimaryKeyConstraint('room_id', 'revision'),
         ))
     except Exception:
         # mapping may already exist
@@ -0,0 +1,128 @@
+"""Insert/delete edit operations on room code.
+
+An op is a dict, either ``{"type": "insert", "pos": int, "text": str}`` or
+``{"type": "delete", "pos": int, "length": int}``. A list of ops is applied in
+order, each position being relative to the document produced by the previous
+op. `transform` rebases a client's ops past ops the server already applied so
+concurrent editors converge on the same text.
+"""
+from collections import deque
+import threading
+from typing import Deque, Dict, List, Optional, Tuple
+
+
+def apply_ops(code: str, ops: List[dict]) -> str:
+    for op in ops:
+        pos = op['pos']
+        if pos < 0 or pos > len(code):
+            raise ValueError(f"position {pos} out of range")
+        if op['type'] == 'insert':
+            code = code[:pos] + op['text'] + code[pos:]
+        else:
+            end = pos + op['length']
+            if end > len(code):
+                raise ValueError(f"delete range {pos}-{end} out of range")
+            code = code[:pos] + code[end:]
+    return code
+
+
+def _shift(op: dict, pos: int) -> dict:
+    return dict(op, pos=pos)
+
+
+def _transform_op(op: dict, against: dict, against_wins: bool) -> List[dict]:
+    # rebase a single op past `against`, which was applied first
+    pos = op['pos']
+    apos = against['pos']
+    if against['type'] == 'insert':
+        alen = len(against['text'])
+        if op['type'] == 'insert':
+            if apos < pos or (apos == pos and against_wins):
+                return [_shift(op, pos + alen)]
+            return [op]
+        end = pos + op['length']
+        if apos <= pos:
+            return [_shift(op, pos + alen)]
+        if apos >= end:
+            return [op]
+        # insert landed inside the deleted range: delete around it
+        return [
+            {'type': 'delete', 'pos': pos, 'length': apos - pos},
+            {'type': 'delete', 'pos': pos + alen, 'length': end - apos},
+        ]
+
+    aend = apos + against['length']
+    if op['type'] == 'insert':
+        if pos <= apos:
+            return [op]
+        if pos >= aend:
+            return [_shift(op, pos - against['length'])]
+        return [_shift(op, apos)]
+    end = pos + op['length']
+    if end <= apos:
+        return [op]
+    if pos >= aend:
+        return [_shift(op, pos - against['length'])]
+    overlap = min(end, aend) - max(pos, apos)
+    remaining = op['length'] - overlap
+    if remaining == 0:
+        return []
+    return [{'type': 'delete', 'pos': min(pos, apos), 'length': remaining}]
+
+
+def _xform(ops: List[dict], applied: List[dict]) -> Tuple[List[dict], List[dict]]:
+    # returns (ops rebased past applied, applied rebased past ops)
+    if not ops or not applied:
+        return ops, applied
+    if len(ops) == 1 and len(applied) == 1:
+        return _transform_op(ops[0], applied[0], True), _transform_op(applied[0], ops[0], False)
+    if len(ops) > 1:
+        head, rest_applied = _xform(ops[:1], applied)
+        tail, rest_applied = _xform(ops[1:], rest_applied)
+        return head + tail, rest_applied
+    ops_1, applied_head = _xform(ops, applied[:1])
+    ops_2, applied_tail = _xform(ops_1, applied[1:])
+    return ops_2, applied_head + applied_tail
+
+
+def transform(ops: List[dict], applied: List[dict]) -> List[dict]:
+    """Rebase `ops` so they apply after `applied`; `applied` wins position ties."""
+    return _xform(ops, applied)[0]
+
+
+class OpLog:
+    """Bounded in-memory log of the ops behind each recent room revision.
+
+    A revision recorded with ``None`` (a whole-document replace) cannot be
+    transformed against, so clients based before it must resync.
+    """
+
+    def __init__(self, size: int = 200):
+        self.size = size
+        self._log: Dict[str, Deque[Tuple[int, Optional[List[dict]]]]] = {}
+        self._lock = threading.Lock()
+
+    def append(self, room_id: str, revision: int, ops: Optional[List[dict]]) -> None:
+        with self._lock:
+            entries = self._log.setdefault(room_id, deque(maxlen=self.size))
+            entries.append((revision, ops))
+
+    def since(self, room_id: str, base_revision: int, revision: int) -> Optional[List[dict]]:
+        # ops that take `base_revision` to `revision`, or None if any are unknown
+        if base_revision == revision:
+            return []
+        with self._lock:
+            entries = list(self._log.get(room_id, ()))
+        missed = [(rev, ops) for rev, ops in entries if base_revision < rev <= revision]
+        if len(missed) != revision - base_revision:
+            return None
+        out: List[dict] = []
+        for _, ops in missed:
+            if ops is None:
+                return None
+            out.extend(ops)
+        return out
+
+    def discard(self, room_id: str) -> None:
+        with self._lock:
+            self._log.pop(room_id, None)
@@ -0,0 +1,129 @@
+"""In-memory room presence.
+
+Who is in a room is tracked by this worker from live connections rather than
+stored as participant rows, so joining and leaving never touch the database.
+Only named participants are persisted.
+
+- A WebSocket subscription is present while it is subscribed. A client that
+  sends heartbeats (``{"action": "ping"}``) is dropped `ttl` seconds after its
+  last one, which catches half-open connections.
+- ``POST /rooms/{id}/join`` hands out a lease that expires after `ttl` seconds
+  unless a WebSocket subscription to the same room adopts it, which is what a
+  browser does right after joining.
+"""
+import os
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Set
+
+
+class _Lease:
+    # anonymous presence from a REST join, waiting for its WebSocket
+    __slots__ = ('created',)
+
+    def __init__(self, created: float):
+        self.created = created
+
+
+class PresenceRegistry:
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        # room_id -> holder -> expiry (monotonic), None while held by a connection without heartbeats
+        self._rooms: Dict[str, Dict[Hashable, Optional[float]]] = {}
+        self._lock = threading.Lock()
+        self.expired = 0
+
+    def lease(self, room_id: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._rooms.setdefault(room_id, {})[_Lease(now)] = now + self.ttl
+
+    def join(self, room_id: str, holder: Hashable) -> bool:
+        """Mark `holder` present in a room; returns False when the count did not change."""
+        with self._lock:
+            holders = self._rooms.setdefault(room_id, {})
+            if holder in holders:
+                return False
+            holders[holder] = None
+            leases = [h for h in holders if isinstance(h, _Lease)]
+            if leases:
+                # the subscription takes over the oldest pending join
+                del holders[min(leases, key=lambda lease: lease.created)]
+                return False
+            return True
+
+    def touch(self, holder: Hashable) -> None:
+        # heartbeat: keep every room `holder` is in for another `ttl` seconds
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for holders in self._rooms.values():
+                if holder in holders:
+                    holders[holder] = expires
+
+    def leave(self, room_id: str, holder: Optional[Hashable] = None) -> bool:
+        """Remove `holder` from a room, or the newest pending join lease when None."""
+        with self._lock:
+            holders = self._rooms.get(room_id)
+            if not holders:
+                return False
+            if holder is None:
+                leases = [h for h in holders if isinstance(h, _Lease)]
+                if not leases:
+                    return False
+                holder = max(leases, key=lambda lease: lease.created)
+            if holder not in holders:
+                return False
+            del holders[holder]
+            if not holders:
+                del self._rooms[room_id]
+            return True
+
+    def leave_all(self, holder: Hashable) -> List[str]:
+        # returns the rooms `holder` was in
+        with self._lock:
+            rooms = [room_id for room_id, holders in self._rooms.items() if holder in holders]
+            for room_id in rooms:
+                del self._rooms[room_id][holder]
+                if not self._rooms[room_id]:
+                    del self._rooms[room_id]
+        return rooms
+
+    def count(self, room_id: str) -> int:
+        now = time.monotonic()
+        with self._lock:
+            holders = self._rooms.get(room_id)
+            if not holders:
+                return 0
+            return sum(1 for expires in holders.values() if expires is None or expires > now)
+
+    def rooms(self) -> Set[str]:
+        with self._lock:
+            return set(self._rooms)
+
+    def sweep(self, now: Optional[float] = None) -> List[str]:
+        """Drop expired leases and silent heartbeat holders; returns the rooms that changed."""
+        now = time.monotonic() if now is None else now
+        changed = []
+        with self._lock:
+            for room_id, holders in list(self._rooms.items()):
+                stale = [h for h, expires in holders.items() if expires is not None and expires <= now]
+                if not stale:
+                    continue
+                for holder in stale:
+                    del holders[holder]
+                self.expired += len(stale)
+                changed.append(room_id)
+                if not holders:
+                    del self._rooms[room_id]
+        return changed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rooms": len(self._rooms),
+                "present": sum(len(holders) for holders in self._rooms.values()),
+                "expired": self.expired,
+            }
+
+
+presence = PresenceRegistry(ttl=int(os.environ.get('PRESENCE_TTL_S', '60')))
@@ -0,0 +1,85 @@
+"""WebSocket wire protocol versions.
+
+Version 1 (the default) exchanges JSON text frames. A client opts into
+version 2 by sending ``{"action": "hello", "version": 2, "encodings":
+["msgpack", "json"], "compress": true}``; the server answers with a
+``WELCOME`` frame in the old format naming the chosen encoding, and every frame
+after that is binary: one flag byte (bit 0 set when the payload is
+deflate-compressed) followed by the payload in the negotiated encoding.
+Payloads smaller than the compression threshold are sent uncompressed.
+"""
+import json
+import zlib
+from typing import Dict, Optional, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:  # optional: version 2 falls back to JSON payloads
+    msgpack = None
+
+
+Frame = Union[str, bytes]
+
+FLAG_DEFLATE = 0x01
+COMPRESS_THRESHOLD = 1024
+
+
+def _deflate(payload: bytes) -> bytes:
+    # raw deflate stream (no zlib header), as produced by DecompressionStream('deflate-raw')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(payload) + compressor.flush()
+
+
+def _inflate(payload: bytes) -> bytes:
+    return zlib.decompress(payload, -15)
+
+
+class Codec:
+    def __init__(self, version: int = 1, encoding: str = 'json', compress: bool = False, threshold: int = COMPRESS_THRESHOLD):
+        self.version = version
+        self.encoding = encoding
+        self.compress = compress
+        self.threshold = threshold
+
+    @property
+    def key(self) -> Tuple[int, str, bool]:
+        return (self.version, self.encoding, self.compress)
+
+    def encode(self, text: str, message: Optional[dict] = None) -> Frame:
+        """Frame a message already serialised as JSON `text` (`message` avoids re-parsing it)."""
+        if self.version == 1:
+            return text
+        if self.encoding == 'msgpack':
+            payload = msgpack.packb(message if message is not None else json.loads(text))
+        else:
+            payload = text.encode()
+        if self.compress and len(payload) >= self.threshold:
+            return bytes([FLAG_DEFLATE]) + _deflate(payload)
+        return b'\x00' + payload
+
+    def decode(self, frame: Frame) -> dict:
+        if isinstance(frame, str):
+            return json.loads(frame)
+        flags, payload = frame[0], frame[1:]
+        if flags & FLAG_DEFLATE:
+            payload = _inflate(payload)
+        if self.encoding == 'msgpack':
+            return msgpack.unpackb(payload)
+        return json.loads(payload)
+
+
+TEXT_JSON = Codec()
+
+
+def available_encodings() -> list:
+    return ['msgpack', 'json'] if msgpack is not None else ['json']
+
+
+def negotiate(hello: dict) -> Codec:
+    """Pick the codec for a client's hello; unknown versions stay on version 1."""
+    if hello.get('version') != 2:
+        return TEXT_JSON
+    wanted = hello.get('encodings') or ['json']
+    encoding = next((e for e in wanted if e in available_encodings()), 'json')
+    return Codec(2, encoding, bool(hello.get('compress')))
+
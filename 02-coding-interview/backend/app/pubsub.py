@@ -0,0 +1,181 @@
+"""Pub/sub backends that carry broadcasts between workers.
+
+A backend receives every encoded broadcast through `publish` and must hand it
+to `deliver(room_id, data)` on every worker, including the publishing one.
+`InMemoryBackend` does this within one process (workers sharing a hub stand in
+for separate processes in tests); `PostgresBackend` uses LISTEN/NOTIFY on the
+application database so uvicorn workers and instances share broadcasts.
+"""
+import asyncio
+from collections import OrderedDict
+import itertools
+import logging
+import threading
+import uuid
+from typing import Callable, List, Optional, Set, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, str], None]
+
+
+class InMemoryHub:
+    def __init__(self):
+        self.backends: Set["InMemoryBackend"] = set()
+
+
+class InMemoryBackend:
+    def __init__(self, hub: Optional[InMemoryHub] = None):
+        self.hub = hub or InMemoryHub()
+        self._deliver: Optional[Deliver] = None
+        # usable before start() so tests without a lifespan still get loopback delivery
+        self.hub.backends.add(self)
+
+    def bind(self, deliver: Deliver) -> None:
+        self._deliver = deliver
+
+    async def start(self, deliver: Deliver) -> None:
+        self.bind(deliver)
+        self.hub.backends.add(self)
+
+    async def stop(self) -> None:
+        self.hub.backends.discard(self)
+
+    async def publish(self, room_id: str, data: str) -> None:
+        for backend in list(self.hub.backends):
+            if backend._deliver is not None:
+                backend._deliver(room_id, data)
+
+
+class PostgresBackend:
+    """Broadcasts over Postgres LISTEN/NOTIFY.
+
+    NOTIFY payloads are limited to 8000 bytes, so larger messages are split
+    into chunks and reassembled by the listeners. Messages are delivered to
+    local subscribers directly and ignored when they come back from Postgres.
+    """
+
+    channel = 'room_updates'
+    chunk_size = 7000
+
+    def __init__(self, url: str):
+        self.url = url
+        self.origin = uuid.uuid4().hex[:12]
+        self._ids = itertools.count()
+        self._deliver: Optional[Deliver] = None
+        self._listen_conn = None
+        self._notify_conn = None
+        self._notify_lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._partial: "OrderedDict[Tuple[str, str], List[Optional[str]]]" = OrderedDict()
+        self._reconnect_task: Optional[asyncio.Task] = None
+
+    def bind(self, deliver: Deliver) -> None:
+        self._deliver = deliver
+
+    def _dsn(self) -> str:
+        from sqlalchemy.engine import make_url
+        # psycopg2 takes a plain libpq URL, without the SQLAlchemy driver suffix
+        return make_url(self.url).set(drivername='postgresql').render_as_string(hide_password=False)
+
+    def _connect(self):
+        import psycopg2
+        conn = psycopg2.connect(self._dsn())
+        conn.autocommit = True
+        return conn
+
+    async def start(self, deliver: Deliver) -> None:
+        self._deliver = deliver
+        self._loop = asyncio.get_running_loop()
+        await self._listen()
+
+    async def _listen(self) -> None:
+        self._listen_conn = await asyncio.to_thread(self._connect)
+        with self._listen_conn.cursor() as cur:
+            cur.execute(f'LISTEN {self.channel}')
+        self._loop.add_reader(self._listen_conn.fileno(), self._on_readable)
+
+    async def _reconnect(self) -> None:
+        delay = 0.5
+        while True:
+            try:
+                await self._listen()
+                return
+            except Exception:
+                logger.warning("pub/sub listener reconnect failed; retrying in %.1fs", delay, exc_info=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10)
+
+    async def stop(self) -> None:
+        if self._reconnect_task:
+            self._reconnect_task.cancel()
+        if self._listen_conn is not None:
+            try:
+                self._loop.remove_reader(self._listen_conn.fileno())
+                self._listen_conn.close()
+            except Exception:
+                pass
+            self._listen_conn = None
+        with self._notify_lock:
+            if self._notify_conn is not None:
+                self._notify_conn.close()
+                self._notify_conn = None
+
+    def _on_readable(self) -> None:
+        conn = self._listen_conn
+        try:
+            conn.poll()
+        except Exception:
+            logger.warning("pub/sub listener connection lost", exc_info=True)
+            self._loop.remove_reader(conn.fileno())
+            self._listen_conn = None
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+            return
+        while conn.notifies:
+            self._receive(conn.notifies.pop(0).payload)
+
+    def _receive(self, payload: str) -> None:
+        origin, msg_id, index, total, room_id, chunk = payload.split(':', 5)
+        if origin == self.origin or self._deliver is None:
+            return
+        index, total = int(index), int(total)
+        if total == 1:
+            self._deliver(room_id, chunk)
+            return
+        key = (origin, msg_id)
+        parts = self._partial.setdefault(key, [None] * total)
+        parts[index] = chunk
+        if all(p is not None for p in parts):
+            del self._partial[key]
+            self._deliver(room_id, ''.join(parts))
+        while len(self._partial) > 1000:
+            # senders that died mid-message never complete
+            self._partial.popitem(last=False)
+
+    def _notify(self, payloads: List[str]) -> None:
+        with self._notify_lock:
+            for attempt in range(2):
+                try:
+                    if self._notify_conn is None or self._notify_conn.closed:
+                        self._notify_conn = self._connect()
+                    with self._notify_conn.cursor() as cur:
+                        for payload in payloads:
+                            cur.execute('SELECT pg_notify(%s, %s)', (self.channel, payload))
+                    return
+                except Exception:
+                    self._notify_conn = None
+                    if attempt:
+                        raise
+
+    async def publish(self, room_id: str, data: str) -> None:
+        if self._deliver is not None:
+            self._deliver(room_id, data)
+        # `data` is ASCII-only JSON, so character offsets are byte offsets
+        msg_id = str(next(self._ids))
+        chunks = [data[i:i + self.chunk_size] for i in range(0, len(data), self.chunk_size)] or ['']
+        payloads = [f'{self.origin}:{msg_id}:{i}:{len(chunks)}:{room_id}:{chunk}' for i, chunk in enumerate(chunks)]
+        try:
+            await asyncio.to_thread(self._notify, payloads)
+        except Exception:
+            logger.warning("publishing broadcast for room %s to other workers failed", room_id, exc_info=True)
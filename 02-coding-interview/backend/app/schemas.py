@@ -1,6 +1,6 @@
 from __future__ import annotations
 from pydantic import BaseModel, Field
-from typing import Literal
+from typing import Annotated, Literal, Union
 
 
 class Room(BaseModel):
@@ -9,6 +9,7 @@ class Room(BaseModel):
     language: Literal["javascript", "python"]
     createdAt: int
     participants: int
+    revision: int = 0
 
 
 class Participant(BaseModel):
@@ -21,10 +22,88 @@ class CreateRoomRequest(BaseModel):
     language: Literal["javascript", "python"] | None = None
 
 
+class BatchRoomSpec(BaseModel):
+    language: Literal["javascript", "python"] | None = None
+    participants: list[str] = Field(default_factory=list, max_length=200)
+
+
+class CreateRoomsBatchRequest(BaseModel):
+    rooms: list[BatchRoomSpec] = Field(min_length=1, max_length=500)
+
+
+class CreatedRoom(BaseModel):
+    room: Room
+    participants: list[Participant]
+
+
+class CreateRoomsBatchResponse(BaseModel):
+    rooms: list[CreatedRoom]
+
+
+class BulkParticipantsRequest(BaseModel):
+    # names of participants to add and ids of participants to remove
+    add: list[Annotated[str, Field(min_length=1)]] = Field(default_factory=list, max_length=500)
+    remove: list[str] = Field(default_factory=list, max_length=500)
+
+
+class BulkParticipantsResponse(BaseModel):
+    room: Room
+    added: list[Participant]
+    removed: list[str]
+
+
 class UpdateCodeRequest(BaseModel):
     code: str
 
 
+class InsertOp(BaseModel):
+    type: Literal["insert"]
+    pos: int = Field(ge=0)
+    text: str
+
+
+class DeleteOp(BaseModel):
+    type: Literal["delete"]
+    pos: int = Field(ge=0)
+    length: int = Field(gt=0)
+
+
+EditOp = Annotated[Union[InsertOp, DeleteOp], Field(discriminator="type")]
+
+
+class ApplyOpsRequest(BaseModel):
+    baseRevision: int = Field(ge=0)
+    ops: list[EditOp]
+    clientId: str | None = None
+
+
+class ApplyOpsResponse(BaseModel):
+    roomId: str
+    revision: int
+    ops: list[EditOp]
+
+
+class RoomRevision(BaseModel):
+    revision: int
+    code: str
+    createdAt: int
+
+
+class RevisionChange(BaseModel):
+    # edit ops that turn the previous revision into this one
+    revision: int
+    ops: list[EditOp]
+    createdAt: int
+
+
+class RevisionHistory(BaseModel):
+    roomId: str
+    revision: int
+    code: str
+    createdAt: int
+    changes: list[RevisionChange]
+
+
 class UpdateLanguageRequest(BaseModel):
     language: Literal["javascript", "python"]
 
@@ -0,0 +1,97 @@
+"""Per-room write-behind buffer for room code.
+
+Code updates are staged here and become visible to readers immediately; the
+owner flushes them to the database in one batch once a room has been idle for
+`idle` seconds or dirty for `max_delay` seconds (the durability bound), and
+unconditionally on shutdown. Only the latest code per room is written, but the
+history rows of every buffered revision are kept and written with it.
+"""
+from dataclasses import dataclass, field
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+@dataclass
+class PendingCode:
+    code: str
+    revision: int
+    first_dirty: float
+    last_write: float
+    # room_revisions rows not yet written, oldest first
+    history: List[dict] = field(default_factory=list)
+
+
+class CodeBuffer:
+    def __init__(self, flush: Callable[[Dict[str, PendingCode]], None], idle: float = 0.5, max_delay: float = 2.0):
+        self._flush = flush
+        self.idle = idle
+        self.max_delay = max_delay
+        self._pending: Dict[str, PendingCode] = {}
+        self._lock = threading.Lock()
+        # serialises flushes so a slow batch is never overtaken by a newer one
+        self._flush_lock = threading.Lock()
+        self.updates = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def put(self, room_id: str, code: str, revision: int, record: Optional[dict] = None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.updates += 1
+            pending = self._pending.get(room_id)
+            first_dirty = pending.first_dirty if pending else now
+            history = pending.history if pending else []
+            if record is not None:
+                history = history + [record]
+            self._pending[room_id] = PendingCode(code, revision, first_dirty, now, history)
+
+    def get(self, room_id: str) -> Optional[PendingCode]:
+        with self._lock:
+            return self._pending.get(room_id)
+
+    def discard(self, room_id: str) -> None:
+        with self._lock:
+            self._pending.pop(room_id, None)
+
+    def due(self, now: Optional[float] = None) -> List[str]:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return [
+                rid for rid, p in self._pending.items()
+                if now - p.last_write >= self.idle or now - p.first_dirty >= self.max_delay
+            ]
+
+    def flush(self, room_ids: Optional[Iterable[str]] = None) -> int:
+        """Write pending code for `room_ids` (all rooms when None); returns rows written."""
+        with self._flush_lock:
+            with self._lock:
+                keys = list(self._pending) if room_ids is None else [r for r in room_ids if r in self._pending]
+                batch = {rid: self._pending[rid] for rid in keys}
+            if not batch:
+                return 0
+            # on failure entries stay buffered and are retried on the next flush
+            self._flush(batch)
+            with self._lock:
+                for rid, written in batch.items():
+                    # keep entries that changed while the batch was being written
+                    current = self._pending.get(rid)
+                    if current is written:
+                        del self._pending[rid]
+                    elif current is not None:
+                        current.history = [r for r in current.history if r['revision'] > written.revision]
+                self.flushes += 1
+                self.rows_written += len(batch)
+            return len(batch)
+
+    def flush_due(self) -> int:
+        return self.flush(self.due())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "updates": self.updates,
+                "flushes": self.flushes,
+                "rowsWritten": self.rows_written,
+            }
@@ -2,6 +2,7 @@ import pytest
 from fastapi.testclient import TestClient
 from app.main import app
 from app import db
+from app.ops import apply_ops
 
 
 client = TestClient(app)
@@ -108,3 +109,216 @@ def test_participants_endpoints():
     lst2 = client.get(f'/rooms/{rid}/participants')
     assert lst2.status_code == 200
     assert all(x['id'] != participant['id'] for x in lst2.json())
+
+
+def test_code_ops():
+    resp = client.post('/rooms', json={})
+    room = resp.json()
+    rid = room['id']
+    code = room['code']
+
+    with client.websocket_connect('/ws') as ws:
+        ws.send_json({'action': 'subscribe', 'roomId': rid})
+        assert ws.receive_json()['type'] == 'ROOM_UPDATE'
+
+        r = client.post(f'/rooms/{rid}/code/ops', json={
+            'baseRevision': room['revision'],
+            'ops': [{'type': 'insert', 'pos': 0, 'text': '// a\n'}],
+        })
+        assert r.status_code == 200
+        assert r.json()['revision'] == room['revision'] + 1
+
+        msg = ws.receive_json()
+        assert msg['type'] == 'CODE_OPS'
+        assert msg['ops'] == [{'type': 'insert', 'pos': 0, 'text': '// a\n'}]
+        assert 'room' not in msg
+
+    # a concurrent edit against the old revision is rebased after the first one
+    r = client.post(f'/rooms/{rid}/code/ops', json={
+        'baseRevision': room['revision'],
+        'ops': [{'type': 'insert', 'pos': len(code), 'text': '// z\n'}],
+    })
+    assert r.status_code == 200
+    got = client.get(f'/rooms/{rid}').json()
+    assert got['code'] == '// a\n' + code + '// z\n'
+    assert got['revision'] == room['revision'] + 2
+
+    # a whole-document replace cannot be rebased over
+    client.patch(f'/rooms/{rid}/code', json={'code': 'x'})
+    r = client.post(f'/rooms/{rid}/code/ops', json={
+        'baseRevision': got['revision'],
+        'ops': [{'type': 'insert', 'pos': 0, 'text': 'y'}],
+    })
+    assert r.status_code == 409
+
+    r = client.post(f'/rooms/{rid}/code/ops', json={
+        'baseRevision': got['revision'] + 1,
+        'ops': [{'type': 'delete', 'pos': 0, 'length': 5}],
+    })
+    assert r.status_code == 400
+
+
+def test_code_updates_are_coalesced_before_writing():
+    room = client.post('/rooms', json={}).json()
+    rid = room['id']
+    for i in range(5):
+        assert client.patch(f'/rooms/{rid}/code', json={'code': f'v{i}'}).status_code == 200
+    # readers see the latest code straight away
+    got = client.get(f'/rooms/{rid}').json()
+    assert got['code'] == 'v4'
+    assert got['revision'] == room['revision'] + 5
+
+    db.flush_code(all_rooms=True)
+    assert db.code_buffer.get(rid) is None
+    session = db.SessionLocal()
+    try:
+        row = session.get(db.models.RoomModel, rid)
+        assert (row.code, row.revision) == ('v4', room['revision'] + 5)
+    finally:
+        session.close()
+
+
+def test_room_cache_is_invalidated_by_participant_changes():
+    room = client.post('/rooms', json={}).json()
+    rid = room['id']
+    before = client.get('/stats').json()['roomCache']
+    assert client.get(f'/rooms/{rid}').status_code == 200
+    assert client.get('/stats').json()['roomCache']['hits'] == before['hits'] + 1
+
+    client.post(f'/rooms/{rid}/participants', json={'name': 'Bob'})
+    assert client.get(f'/rooms/{rid}').json()['participants'] == room['participants'] + 1
+
+
+def test_metrics_endpoint():
+    rid = client.post('/rooms', json={}).json()['id']
+    client.get(f'/rooms/{rid}')
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    body = resp.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/rooms/{room_id}",status="200"}' in body
+    assert 'db_query_duration_seconds_count' in body
+    assert 'ws_subscribers ' in body
+
+
+def test_create_rooms_batch():
+    resp = client.post('/rooms/batch', json={'rooms': [
+        {'language': 'python', 'participants': ['Alice', 'Bob']},
+        {},
+        {'participants': ['Carol']},
+    ]})
+    assert resp.status_code == 201
+    created = resp.json()['rooms']
+    assert len(created) == 3
+    assert len({c['room']['id'] for c in created}) == 3
+    assert created[0]['room']['language'] == 'python'
+    assert created[1]['room']['language'] == 'javascript'
+    assert [p['name'] for p in created[0]['participants']] == ['Alice', 'Bob']
+    assert created[0]['room']['participants'] == 2
+
+    rid = created[2]['room']['id']
+    assert client.get(f'/rooms/{rid}').json()['participants'] == 1
+    assert [p['name'] for p in client.get(f'/rooms/{rid}/participants').json()] == ['Carol']
+
+    assert client.post('/rooms/batch', json={'rooms': []}).status_code == 422
+
+
+def test_bulk_participants():
+    room = client.post('/rooms', json={}).json()
+    rid = room['id']
+    names = [f'viewer{i}' for i in range(50)]
+
+    with client.websocket_connect('/ws') as ws:
+        ws.send_json({'action': 'subscribe', 'roomId': rid})
+        assert ws.receive_json()['room']['participants'] == room['participants']
+
+        r = client.post(f'/rooms/{rid}/participants/bulk', json={'add': names})
+        assert r.status_code == 200
+        body = r.json()
+        assert [p['name'] for p in body['added']] == names
+        assert body['room']['participants'] == room['participants'] + 50
+        # a single snapshot for the whole batch
+        assert ws.receive_json()['room']['participants'] == room['participants'] + 50
+
+    remove = [p['id'] for p in body['added'][:10]] + ['missing']
+    r = client.post(f'/rooms/{rid}/participants/bulk', json={'remove': remove})
+    assert sorted(r.json()['removed']) == sorted(remove[:10])
+    assert r.json()['room']['participants'] == room['participants'] + 40
+    assert len(client.get(f'/rooms/{rid}/participants').json()) == room['participants'] + 40
+
+    assert client.post('/rooms/NOPE00/participants/bulk', json={'add': ['x']}).status_code == 404
+
+
+def test_websocket_batched_subscribe():
+    rids = [client.post('/rooms', json={}).json()['id'] for _ in range(3)]
+
+    with client.websocket_connect('/ws') as ws:
+        ws.send_json({'action': 'subscribe', 'roomIds': rids})
+        assert sorted(ws.receive_json()['roomId'] for _ in rids) == sorted(rids)
+
+        ws.send_json({'action': 'unsubscribe', 'roomIds': rids[1:]})
+        client.patch(f'/rooms/{rids[2]}/code', json={'code': 'ignored'})
+        client.patch(f'/rooms/{rids[0]}/code', json={'code': 'seen'})
+        msg = ws.receive_json()
+        assert msg['roomId'] == rids[0] and msg['room']['code'] == 'seen'
+
+
+def test_websocket_binary_protocol():
+    msgpack = pytest.importorskip('msgpack')
+    from app.protocol import Codec, FLAG_DEFLATE
+
+    rid = client.post('/rooms', json={}).json()['id']
+    codec = Codec(2, 'msgpack', True)
+    with client.websocket_connect('/ws') as ws:
+        ws.send_json({'action': 'hello', 'version': 2, 'encodings': ['msgpack', 'json'], 'compress': True})
+        welcome = ws.receive_json()
+        assert welcome['type'] == 'WELCOME' and welcome['encoding'] == 'msgpack'
+
+        # after the handshake both directions use binary frames
+        ws.send_bytes(b'\x00' + msgpack.packb({'action': 'subscribe', 'roomId': rid}))
+        frame = ws.receive_bytes()
+        assert frame[0] == 0
+        assert codec.decode(frame)['roomId'] == rid
+
+        big = 'x = 1\n' * 2000
+        client.patch(f'/rooms/{rid}/code', json={'code': big})
+        frame = ws.receive_bytes()
+        assert frame[0] & FLAG_DEFLATE and len(frame) < len(big)
+        assert codec.decode(frame)['room']['code'] == big
+
+
+def test_revision_history(monkeypatch):
+    from app import history
+    monkeypatch.setattr(history, 'KEYFRAME_INTERVAL', 4)
+
+    room = client.post('/rooms', json={}).json()
+    rid = room['id']
+    codes = [room['code']]
+    for i in range(5):
+        codes.append(codes[-1] + f'line {i}\n')
+        assert client.patch(f'/rooms/{rid}/code', json={'code': codes[-1]}).status_code == 200
+    r = client.post(f'/rooms/{rid}/code/ops', json={'baseRevision': 5, 'ops': [{'type': 'delete', 'pos': 0, 'length': 3}]})
+    assert r.status_code == 200
+    codes.append(codes[-1][3:])
+    codes.append('a whole new\ndocument\n')
+    client.patch(f'/rooms/{rid}/code', json={'code': codes[-1]})
+
+    for rev, code in enumerate(codes):
+        assert client.get(f'/rooms/{rid}/revisions/{rev}').json()['code'] == code
+    assert client.get(f'/rooms/{rid}/revisions/99').status_code == 404
+    assert client.get('/rooms/NOPE00/revisions/0').json()['detail'] == 'Room not found'
+
+    # stored as keyframes every 4 revisions plus deltas
+    with db.engine.connect() as conn:
+        kinds = conn.execute(db.select(db.models.RoomRevisionModel.__table__.c.keyframe).where(
+            db.models.RoomRevisionModel.__table__.c.room_id == rid
+        ).order_by(db.models.RoomRevisionModel.__table__.c.revision)).scalars().all()
+    assert kinds == [True, False, False, False, True, False, False, False]
+
+    body = client.get(f'/rooms/{rid}/revisions', params={'from': 2, 'to': 6}).json()
+    assert body['revision'] == 2 and body['code'] == codes[2]
+    assert [c['revision'] for c in body['changes']] == [3, 4, 5, 6]
+    code = body['code']
+    for change in body['changes']:
+        code = apply_ops(code, change['ops'])
+        assert code == codes[change['revision']]
+    assert client.get(f'/rooms/{rid}/revisions', params={'from': 3, 'to': 1}).status_code == 400
@@ -0,0 +1,122 @@
+import asyncio
+import json
+
+from app.broadcaster import Broadcaster
+from app.pubsub import InMemoryBackend, InMemoryHub, PostgresBackend
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.gate = asyncio.Event()
+        self.closed_with = None
+
+    async def send_text(self, data):
+        await self.gate.wait()
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+def test_slow_consumer_does_not_block_others_and_is_resynced():
+    async def scenario():
+        b = Broadcaster(queue_size=2, send_timeout=5)
+
+        async def snapshot(room_id):
+            return {"type": "ROOM_UPDATE", "roomId": room_id, "room": {"code": "latest"}}
+
+        b.snapshot_loader = snapshot
+        fast, slow = FakeWebSocket(), FakeWebSocket()
+        fast.gate.set()
+        await b.subscribe(fast, 'r1')
+        await b.subscribe(slow, 'r1')
+
+        for i in range(5):
+            await b.broadcast('R1', {"type": "CODE_OPS", "n": i})
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.01)
+        assert [m['n'] for m in fast.sent] == [0, 1, 2, 3, 4]
+        assert slow.sent == []
+        assert b.downgrades == 1
+
+        slow.gate.set()
+        await asyncio.sleep(0.01)
+        # the backlog was replaced with a fresh snapshot
+        assert slow.sent[-1] == {"type": "ROOM_UPDATE", "roomId": 'R1', "room": {"code": "latest"}}
+        await b.unsubscribe(fast)
+        await b.unsubscribe(slow)
+
+    asyncio.run(scenario())
+
+
+def test_stuck_consumer_is_dropped():
+    async def scenario():
+        b = Broadcaster(queue_size=4, send_timeout=0.01)
+        stuck = FakeWebSocket()
+        await b.subscribe(stuck, 'r1')
+        await b.broadcast('r1', {"type": "ROOM_UPDATE"})
+        await asyncio.sleep(0.05)
+        assert stuck not in b.subscribers['R1']
+        assert stuck.closed_with == 1013
+        assert b.failed_sends == 1
+
+    asyncio.run(scenario())
+
+
+def test_broadcasts_reach_subscribers_of_other_workers():
+    async def scenario():
+        hub = InMemoryHub()
+        worker_a = Broadcaster(backend=InMemoryBackend(hub))
+        worker_b = Broadcaster(backend=InMemoryBackend(hub))
+        ws_a, ws_b = FakeWebSocket(), FakeWebSocket()
+        ws_a.gate.set()
+        ws_b.gate.set()
+        await worker_a.subscribe(ws_a, 'r1')
+        await worker_b.subscribe(ws_b, 'r1')
+
+        await worker_a.broadcast('r1', {"type": "ROOM_UPDATE", "roomId": "R1"})
+        await asyncio.sleep(0.01)
+        assert ws_a.sent == ws_b.sent == [{"type": "ROOM_UPDATE", "roomId": "R1"}]
+
+        await worker_b.stop()
+        await worker_a.broadcast('r1', {"type": "ROOM_UPDATE", "roomId": "R1"})
+        await asyncio.sleep(0.01)
+        assert len(ws_a.sent) == 2 and len(ws_b.sent) == 1
+
+    asyncio.run(scenario())
+
+
+def test_postgres_backend_chunks_large_payloads():
+    async def scenario():
+        sender = PostgresBackend('postgresql+psycopg2://user:pw@localhost/db')
+        receiver = PostgresBackend('postgresql+psycopg2://user:pw@localhost/db')
+        received = []
+        receiver.bind(lambda room_id, data: received.append((room_id, data)))
+        sender._notify = lambda payloads: [receiver._receive(p) for p in payloads]
+
+        data = Broadcaster.encode({"type": "ROOM_UPDATE", "room": {"code": "x" * 20000}})
+        await sender.publish('R1', data)
+        assert received == [('R1', data)]
+
+    asyncio.run(scenario())
+
+
+def test_room_snapshots_are_coalesced_per_window():
+    async def scenario():
+        b = Broadcaster(coalesce_window=0.05)
+        ws = FakeWebSocket()
+        ws.gate.set()
+        await b.subscribe(ws, 'r1')
+
+        for i in range(5):
+            await b.schedule('r1', {"type": "ROOM_UPDATE", "n": i})
+        await asyncio.sleep(0.01)
+        # the first snapshot is not delayed
+        assert [m['n'] for m in ws.sent] == [0]
+        await asyncio.sleep(0.08)
+        # the rest of the burst collapses into the latest snapshot
+        assert [m['n'] for m in ws.sent] == [0, 4]
+        assert b.coalesced_messages == 3
+
+    asyncio.run(scenario())
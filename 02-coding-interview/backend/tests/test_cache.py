@@ -0,0 +1,36 @@
+import time
+
+from app.cache import RoomCache
+
+
+def test_lru_eviction_and_counters():
+    cache = RoomCache(max_size=2, ttl=60)
+    cache.put('A', 1)
+    cache.put('B', 2)
+    assert cache.get('A')[0] == 1
+    cache.put('C', 3)
+    # B was least recently used
+    assert cache.get('B')[0] is None
+    assert cache.get('C')[0] == 3
+    stats = cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+
+
+def test_ttl_expiry():
+    cache = RoomCache(max_size=10, ttl=0.01)
+    cache.put('A', 1)
+    time.sleep(0.02)
+    assert cache.get('A')[0] is None
+    assert cache.stats()['expirations'] == 1
+
+
+def test_fill_after_invalidation_is_dropped():
+    cache = RoomCache(max_size=10, ttl=60)
+    value, generation = cache.get('A')
+    assert value is None
+    # a mutator invalidates while the miss is being loaded
+    cache.invalidate('A')
+    cache.fill('A', 'stale', generation)
+    assert cache.get('A')[0] is None
@@ -0,0 +1,55 @@
+import asyncio
+import time
+
+from fastapi.testclient import TestClient
+from sqlalchemy import insert, update
+
+from app import db, models
+from app.broadcaster import Broadcaster
+from app.expiry import RoomExpiry
+from app.main import app
+
+
+client = TestClient(app)
+
+
+def _age(room_id, ms):
+    rooms = models.RoomModel.__table__
+    participants = models.ParticipantModel.__table__
+    with db.engine.begin() as conn:
+        conn.execute(update(rooms).where(rooms.c.id == room_id).values(updated_at=ms, created_at=ms))
+        conn.execute(update(participants).where(participants.c.room_id == room_id).values(joined_at=ms))
+
+
+def test_idle_rooms_are_expired_in_batches():
+    idle = [client.post('/rooms', json={}).json()['id'] for _ in range(5)]
+    watched = client.post('/rooms', json={}).json()['id']
+    joined = client.post('/rooms', json={}).json()['id']
+    for rid in idle + [watched, joined]:
+        _age(rid, 1000)
+    client.post(f'/rooms/{joined}/join')
+    # a participant whose room is long gone
+    with db.engine.begin() as conn:
+        conn.execute(insert(models.ParticipantModel.__table__), {"id": "ORPHAN", "room_id": "GONE00", "name": None, "joined_at": 1})
+
+    broadcaster = Broadcaster()
+    broadcaster.subscribers[watched] = {object()}
+    broadcaster.subscribers['EMPTY0'] = set()
+    expiry = RoomExpiry(broadcaster, ttl=3600, batch_size=2, pause=0)
+    assert asyncio.run(expiry.collect()) == 5
+
+    for rid in idle:
+        assert client.get(f'/rooms/{rid}').status_code == 404
+        assert client.get(f'/rooms/{rid}/revisions/0').status_code == 404
+    assert client.get(f'/rooms/{watched}').status_code == 200
+    assert client.get(f'/rooms/{joined}').status_code == 200
+    assert 'EMPTY0' not in broadcaster.subscribers
+    stats = expiry.stats()
+    assert stats['roomsExpired'] == 5 and stats['orphansPurged'] >= 1 and stats['subscribersPruned'] == 1
+
+
+def test_recent_rooms_are_kept():
+    rid = client.post('/rooms', json={}).json()['id']
+    cutoff = int(time.time() * 1000) - 60_000
+    assert rid not in db.expire_rooms(cutoff)
+    assert client.get(f'/rooms/{rid}').status_code == 200
@@ -0,0 +1,32 @@
+import random
+
+from app.history import diff_ops, pack_ops, replay, revision_row, unpack_ops
+from app.ops import apply_ops
+
+
+def test_diff_ops_round_trip():
+    random.seed(7)
+    lines = ['def f():\n', '    return 1\n', 'x = 2\n', '\n', 'print(x)\n', '# note\n']
+    for _ in range(300):
+        old = ''.join(random.choices(lines, k=random.randint(0, 12)))
+        new = ''.join(random.choices(lines, k=random.randint(0, 12)))
+        if random.random() < 0.3:
+            new = new.replace('x', 'y', 1)
+        ops = diff_ops(old, new)
+        assert apply_ops(old, ops) == new
+        assert unpack_ops(pack_ops(ops)) == ops
+
+
+def test_diff_ops_is_local():
+    old = 'a\n' * 1000
+    new = old[:1000] + 'b' + old[1000:]
+    assert diff_ops(old, new) == [{'type': 'insert', 'pos': 1000, 'text': 'b'}]
+    assert diff_ops(old, old) == []
+
+
+def test_replay_from_keyframe():
+    rows = [revision_row(0, 'abc', None)]
+    rows.append(revision_row(1, 'abcd', [{'type': 'insert', 'pos': 3, 'text': 'd'}]))
+    assert rows[0]['keyframe'] and not rows[1]['keyframe']
+    out = list(replay((r['revision'], r['keyframe'], r['data'], r['created_at']) for r in rows))
+    assert [code for _, code, _ in out] == ['abc', 'abcd']
@@ -0,0 +1,29 @@
+from sqlalchemy import create_engine, inspect, text
+
+from app import migrations
+
+
+def test_upgrades_database_created_by_create_all(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE rooms (id VARCHAR(32) PRIMARY KEY, code TEXT NOT NULL, language VARCHAR(16) NOT NULL, created_at INTEGER NOT NULL)'))
+        conn.execute(text('CREATE TABLE participants (id VARCHAR(32) PRIMARY KEY, room_id VARCHAR(32) NOT NULL, name VARCHAR(128), joined_at INTEGER NOT NULL)'))
+        conn.execute(text("INSERT INTO rooms VALUES ('ABC123', 'x', 'python', 1)"))
+
+    assert migrations.run(engine) == [v for v, _, _ in migrations.MIGRATIONS]
+    assert migrations.run(engine) == []
+
+    insp = inspect(engine)
+    assert 'revision' in {c['name'] for c in insp.get_columns('rooms')}
+    assert 'ix_participants_room_id_joined_at' in {ix['name'] for ix in insp.get_indexes('participants')}
+    assert {'ix_rooms_created_at', 'ix_rooms_updated_at'} <= {ix['name'] for ix in insp.get_indexes('rooms')}
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT revision, updated_at FROM rooms WHERE id = 'ABC123'")).one() == (0, 1)
+        # existing code becomes the first keyframe of the room's history
+        assert conn.execute(text("SELECT revision, data FROM room_revisions WHERE room_id = 'ABC123' AND keyframe")).one() == (0, 'x')
+
+
+def test_fresh_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    migrations.run(engine)
+    assert {'rooms', 'participants', 'schema_migrations'} <= set(inspect(engine).get_table_names())
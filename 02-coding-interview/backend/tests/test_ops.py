@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from app.ops import OpLog, apply_ops, transform, _xform
+
+
+def _random_ops(doc, n):
+    ops = []
+    for _ in range(n):
+        if doc and random.random() < 0.5:
+            pos = random.randrange(len(doc))
+            op = {'type': 'delete', 'pos': pos, 'length': random.randint(1, len(doc) - pos)}
+        else:
+            op = {'type': 'insert', 'pos': random.randint(0, len(doc)), 'text': random.choice(['x', 'yy', 'zzz'])}
+        ops.append(op)
+        doc = apply_ops(doc, [op])
+    return ops
+
+
+def test_apply_ops():
+    assert apply_ops('hello', [{'type': 'insert', 'pos': 5, 'text': '!'}]) == 'hello!'
+    assert apply_ops('hello', [{'type': 'delete', 'pos': 0, 'length': 1}, {'type': 'insert', 'pos': 0, 'text': 'j'}]) == 'jello'
+    with pytest.raises(ValueError):
+        apply_ops('abc', [{'type': 'delete', 'pos': 2, 'length': 5}])
+
+
+def test_transform_concurrent_inserts():
+    doc = 'ac'
+    theirs = [{'type': 'insert', 'pos': 1, 'text': 'b'}]
+    mine = [{'type': 'insert', 'pos': 2, 'text': 'd'}]
+    assert apply_ops(apply_ops(doc, theirs), transform(mine, theirs)) == 'abcd'
+
+
+def test_transform_converges():
+    random.seed(1234)
+    for _ in range(2000):
+        doc = ''.join(random.choice('abcdef') for _ in range(random.randint(0, 12)))
+        mine = _random_ops(doc, random.randint(1, 3))
+        theirs = _random_ops(doc, random.randint(1, 3))
+        mine_rebased, theirs_rebased = _xform(mine, theirs)
+        assert apply_ops(apply_ops(doc, theirs), mine_rebased) == apply_ops(apply_ops(doc, mine), theirs_rebased)
+
+
+def test_op_log_since():
+    log = OpLog(size=3)
+    log.append('R', 1, [{'type': 'insert', 'pos': 0, 'text': 'a'}])
+    log.append('R', 2, [{'type': 'insert', 'pos': 1, 'text': 'b'}])
+    assert log.since('R', 2, 2) == []
+    assert [op['text'] for op in log.since('R', 0, 2)] == ['a', 'b']
+    log.append('R', 3, None)
+    assert log.since('R', 1, 3) is None
+    log.append('R', 4, [])
+    # revision 1 has been evicted
+    assert log.since('R', 0, 4) is None